@@ -0,0 +1,6 @@
+"""
+Benchmark cho bot 5S (không cần Telegram thật):
+- bench.fake_api : Bot API giả lập (sinh ảnh JPEG cho getFile, ghi lại sendMessage/editMessageText...)
+- bench.e2e      : chạy Application thật từ bot.build_app() với lưu lượng giả lập, in p50/p95/p99
+- bench.kernels  : micro-benchmark các kernel chấm điểm (thời gian + bộ nhớ cấp phát), so với baseline
+"""
@@ -0,0 +1,334 @@
+"""
+Benchmark end-to-end: chạy Application thật từ bot.build_app() với Bot API giả lập (bench.fake_api, process riêng)
+và lưu lượng giả lập: N kho × M ảnh rải đều trong `--duration` giây, theo các kiểu gửi
+  album   : 1 album M ảnh, caption "<ID> - <Tên>" ở ảnh đầu
+  text    : 1 tin "<ID> - <Tên>" rồi M ảnh không caption
+  caption : M ảnh lẻ, ảnh nào cũng có caption
+`--dup-rate`: tỉ lệ ảnh gửi lại bytes của 1 ảnh đã gửi trước đó (file_id khác, nội dung giống).
+
+In p50/p95/p99 thời gian xử lý của photo_handler, text_handler, _handle_photos, ack_photo_progress,
+send_daily_report; photo_e2e = từ lúc update ảnh vào hàng đợi tới khi xử lý xong; throughput; số lời gọi API / ảnh.
+
+    python -m bench.e2e --warehouses 500 --photos 4 --duration 120 --chats 50 --json out.json
+Các biến môi trường của bot (ALBUM_WINDOW, CONCURRENT_UPDATES, SEND_CHAT_RATE...) vẫn có hiệu lực.
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+PATTERNS = ("album", "text", "caption")
+TIMED = ("photo_handler", "text_handler", "_handle_photos", "ack_photo_progress", "send_daily_report")
+
+
+# ========= LƯU LƯỢNG GIẢ LẬP =========
+def _photo_sizes(seed: int, side: int, tag: str) -> list:
+    sizes = sorted({320, 800, side})
+    return [{"file_id": f"p{seed}_{s}{tag}", "file_unique_id": f"u{seed}_{s}",
+             "width": s, "height": s * 3 // 4} for s in sizes]
+
+def build_traffic(args) -> tuple:
+    """Trả về (events [(giây, update dict)], file_id cần sinh trước, số ảnh)."""
+    rng = random.Random(args.seed)
+    mix = [(p, w) for p, w in args.mix.items() if w > 0]
+    events, file_ids, used_seeds = [], [], []
+    n_photos = 0
+    ids = iter(range(1, 10 ** 9))
+
+    def message(chat_id, user_id, **kw):
+        mid = next(ids)
+        m = {"message_id": mid, "date": 0, "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+             "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}}
+        m.update(kw)
+        return {"update_id": mid, "message": m}
+
+    def photo(chat_id, user_id, **kw):
+        nonlocal n_photos
+        n_photos += 1
+        if used_seeds and rng.random() < args.dup_rate:
+            seed, tag = rng.choice(used_seeds), f"_d{n_photos}"
+        else:
+            seed, tag = args.seed * 1_000_000 + n_photos, ""
+            used_seeds.append(seed)
+        sizes = _photo_sizes(seed, args.side, tag)
+        file_ids.append(sizes[-1]["file_id"])
+        return message(chat_id, user_id, photo=sizes, **kw)
+
+    for i in range(args.warehouses):
+        kid = str(args.first_id + i)
+        caption = f"{kid} - Kho {kid}"
+        chat_id, user_id = -1000000000000 - (i % args.chats), 10000 + i
+        t0 = rng.uniform(0, args.duration)
+        pattern = rng.choices([p for p, _ in mix], [w for _, w in mix])[0]
+        if pattern == "album":
+            for k in range(args.photos):
+                kw = {"media_group_id": f"mg{kid}"}
+                if k == 0:
+                    kw["caption"] = caption
+                events.append((t0 + k * 0.05, photo(chat_id, user_id, **kw)))
+        elif pattern == "text":
+            events.append((t0, message(chat_id, user_id, text=caption)))
+            for k in range(args.photos):
+                events.append((t0 + 0.5 + k * 0.3, photo(chat_id, user_id)))
+        else:
+            for k in range(args.photos):
+                events.append((t0 + k * 0.5, photo(chat_id, user_id, caption=caption)))
+    events.sort(key=lambda e: e[0])
+    return events, file_ids, n_photos
+
+def write_kho_excel(path: str, args):
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["id_kho", "ten_kho"])
+    for i in range(args.warehouses):
+        ws.append([args.first_id + i, f"Kho {args.first_id + i}"])
+    wb.save(path)
+
+
+# ========= ĐO THỜI GIAN =========
+class Recorder:
+    def __init__(self):
+        self.lat = defaultdict(list)   # tên -> [giây]
+        self.enqueued = {}             # message_id -> perf_counter lúc đưa vào hàng đợi
+        self.inflight = 0
+        self.photos_done = 0
+        self.last_done = 0.0
+
+def percentiles(xs: list) -> dict:
+    if not xs:
+        return {"n": 0}
+    xs = sorted(xs)
+    pick = lambda q: xs[min(len(xs) - 1, int(round(q * (len(xs) - 1))))]
+    return {"n": len(xs), "p50": pick(0.50) * 1000, "p95": pick(0.95) * 1000,
+            "p99": pick(0.99) * 1000, "max": xs[-1] * 1000}
+
+def instrument(bot, rec: Recorder):
+    """Bọc các hàm của bot bằng bộ đo (trước build_app để handler đăng ký bản đã bọc)."""
+    def timed(name, fn):
+        @functools.wraps(fn)
+        async def wrapper(*a, **kw):
+            t0 = time.perf_counter()
+            rec.inflight += 1
+            try:
+                return await fn(*a, **kw)
+            finally:
+                rec.inflight -= 1
+                now = time.perf_counter()
+                rec.lat[name].append(now - t0)
+                if name == "_handle_photos":
+                    for m in a[1]:
+                        ts = rec.enqueued.pop(m.message_id, None)
+                        if ts is not None:
+                            rec.lat["photo_e2e"].append(now - ts)
+                    rec.photos_done += len(a[1])
+                    rec.last_done = now
+        return wrapper
+    for name in TIMED:
+        fn = getattr(bot, name)
+        assert inspect.iscoroutinefunction(fn), name
+        setattr(bot, name, timed(name, fn))
+
+
+# ========= BOT API GIẢ LẬP (process riêng, không tranh GIL với bot) =========
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _api_call(url: str, path: str, payload=None) -> dict:
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url + path, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=600) as r:
+        return json.loads(r.read())
+
+def start_fake_api(args) -> tuple:
+    port = _free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "bench.fake_api", "--port", str(port),
+                             "--delay", str(args.api_delay), "--flood", str(args.flood)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            _api_call(url, "/_stats")
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Bot API giả lập không khởi động được")
+
+
+# ========= CHẠY =========
+async def _settle(app, bot, rec: Recorder, timeout: float):
+    """Chờ tới khi hết việc: không handler nào chạy, hết album/job hẹn giờ, hàng đợi gửi tin rỗng."""
+    from apscheduler.triggers.date import DateTrigger
+    deadline = time.monotonic() + timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        busy = (rec.inflight or not app.update_queue.empty() or len(bot.ALBUM_BUFFER) or bot.OUTBOX.pending()
+                or any(isinstance(j.job.trigger, DateTrigger) for j in app.job_queue.jobs()))
+        if busy:
+            idle_since = None
+        elif idle_since is None:
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > 0.5:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+async def run(args, api_url: str, events: list, n_photos: int) -> dict:
+    import bot
+    from telegram import Update
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    rec = Recorder()
+    instrument(bot, rec)
+    app = bot.build_app()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    _api_call(api_url, "/bot/_reset", {})
+
+    loop = asyncio.get_running_loop()
+    t_start = loop.time()
+    p_start = time.perf_counter()
+    for t, u in events:
+        delay = t_start + t - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        u["message"]["date"] = int(time.time())
+        rec.enqueued[u["message"]["message_id"]] = time.perf_counter()
+        await app.update_queue.put(Update.de_json(u, app.bot))
+    settled = await _settle(app, bot, rec, args.settle_timeout)
+    p_end = rec.last_done or time.perf_counter()
+    traffic_api = _api_call(api_url, "/_stats")
+
+    _api_call(api_url, "/bot/_reset", {})
+    app.job_queue.run_once(bot.send_daily_report, 0)
+    await asyncio.sleep(0.1)
+    await _settle(app, bot, rec, args.settle_timeout)
+    report_api = _api_call(api_url, "/_stats")
+
+    await app.stop()
+    if app.post_stop:
+        await app.post_stop(app)
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+    calls = traffic_api["calls"]
+    elapsed = p_end - p_start
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "verbose", "keep")},
+        "settled": settled,
+        "photos": n_photos,
+        "photos_processed": rec.photos_done,
+        "updates": len(events),
+        "elapsed_s": elapsed,
+        "throughput_photos_s": rec.photos_done / elapsed if elapsed > 0 else 0.0,
+        "offered_photos_s": n_photos / args.duration if args.duration else 0.0,
+        "latency_ms": {name: percentiles(rec.lat[name]) for name in TIMED + ("photo_e2e",)},
+        "api": {
+            "calls": calls,
+            "flooded": traffic_api["flooded"],
+            "calls_per_photo": sum(calls.values()) / max(n_photos, 1),
+            "messages_per_photo": (calls.get("sendMessage", 0) + calls.get("editMessageText", 0)) / max(n_photos, 1),
+        },
+        "report_api_calls": report_api["calls"],
+    }
+
+def print_report(rep: dict):
+    print(f"ảnh: {rep['photos_processed']}/{rep['photos']} · update: {rep['updates']} · "
+          f"{rep['elapsed_s']:.1f}s · {rep['throughput_photos_s']:.1f} ảnh/s "
+          f"(lưu lượng vào {rep['offered_photos_s']:.1f} ảnh/s)" + ("" if rep["settled"] else " · CHƯA XỬ LÝ XONG"))
+    print(f"{'ms':22s}{'n':>7s}{'p50':>10s}{'p95':>10s}{'p99':>10s}{'max':>10s}")
+    for name, s in rep["latency_ms"].items():
+        if s["n"]:
+            print(f"{name:22s}{s['n']:7d}{s['p50']:10.1f}{s['p95']:10.1f}{s['p99']:10.1f}{s['max']:10.1f}")
+    api = rep["api"]
+    print(f"API: {api['calls_per_photo']:.2f} lời gọi/ảnh · {api['messages_per_photo']:.2f} tin gửi+sửa/ảnh · "
+          f"429: {api['flooded']} · " + ", ".join(f"{k}={v}" for k, v in sorted(api["calls"].items())))
+    print("báo cáo ngày: " + (", ".join(f"{k}={v}" for k, v in sorted(rep["report_api_calls"].items())) or "-"))
+
+def _parse_mix(s: str) -> dict:
+    mix = {}
+    for part in s.split(","):
+        name, _, w = part.partition("=")
+        if name.strip() not in PATTERNS:
+            raise argparse.ArgumentTypeError(f"kiểu gửi không hợp lệ: {name} (chọn trong {', '.join(PATTERNS)})")
+        mix[name.strip()] = float(w or 1)
+    return mix
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench.e2e", description="Benchmark end-to-end bot 5S")
+    ap.add_argument("--warehouses", type=int, default=500)
+    ap.add_argument("--photos", type=int, default=4, help="số ảnh mỗi kho")
+    ap.add_argument("--duration", type=float, default=60, help="rải lưu lượng trong bao nhiêu giây")
+    ap.add_argument("--chats", type=int, default=20, help="số group")
+    ap.add_argument("--mix", type=_parse_mix, default=_parse_mix("album=0.5,text=0.25,caption=0.25"))
+    ap.add_argument("--dup-rate", type=float, default=0.05)
+    ap.add_argument("--side", type=int, default=1280, help="cạnh dài ảnh lớn nhất (px)")
+    ap.add_argument("--first-id", type=int, default=1001, help="ID kho đầu tiên")
+    ap.add_argument("--api-delay", type=float, default=0.02, help="độ trễ mỗi lời gọi Bot API (giây)")
+    ap.add_argument("--flood", type=float, default=0.0, help="tỉ lệ sendMessage/editMessageText bị 429")
+    ap.add_argument("--scoring", action="store_true", help="bật chấm điểm 5S (SCORING_ENABLED=1)")
+    ap.add_argument("--storage", choices=("json", "sqlite"), default="json")
+    ap.add_argument("--settle-timeout", type=float, default=300)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--workdir", help="thư mục dữ liệu của bot (mặc định: thư mục tạm, xoá khi xong)")
+    ap.add_argument("--keep", action="store_true", help="giữ thư mục dữ liệu")
+    ap.add_argument("--json", help="ghi kết quả ra file JSON")
+    ap.add_argument("--verbose", action="store_true", help="giữ log INFO của bot")
+    args = ap.parse_args(argv)
+
+    events, file_ids, n_photos = build_traffic(args)
+    proc, api_url = start_fake_api(args)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench5s-")
+    cwd = os.getcwd()
+    try:
+        _api_call(api_url, "/bot/_prepare", {"file_ids": file_ids})  # sinh ảnh trước, ngoài phần đo
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        write_kho_excel("danh_sach_nv_theo_id_kho.xlsx", args)
+        os.environ.update({
+            "BOT_TOKEN": "123456:BENCH",
+            "BOT_API_BASE_URL": f"{api_url}/bot",
+            "BOT_API_FILE_URL": f"{api_url}/file/bot",
+            "REPORT_CHAT_IDS": str(-1000000000000),
+            "STORAGE_BACKEND": args.storage,
+            "SCORING_ENABLED": "1" if args.scoring else "0",
+            "RETENTION_DAYS": "0",
+            "KHO_RELOAD_INTERVAL": "0",
+        })
+        sys.path.insert(0, str(ROOT))
+        rep = asyncio.run(run(args, api_url, events, n_photos))
+    finally:
+        os.chdir(cwd)
+        proc.terminate()
+        proc.wait()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(rep)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rep, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Bot API giả lập cho benchmark.
+
+file_id ảnh có dạng "p<seed>_<cạnh dài>[_<biến thể>]": server sinh JPEG theo seed (cùng seed → cùng bytes),
+nên không cần upload ảnh trước. Mọi lời gọi được đếm theo method; xem GET /_stats, xoá bằng POST /_reset.
+Chạy riêng: python -m bench.fake_api --port 8081 [--delay 0.02] [--flood 0.01]
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PHOTO_RX = re.compile(r"^p(\d+)_(\d+)")
+
+def make_jpeg(seed: int, side: int) -> bytes:
+    """Ảnh 4:3 cạnh dài `side`: các mảng màu ngẫu nhiên + cạnh rõ (đủ để pHash/chấm điểm khác nhau theo seed)."""
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    w, h = side, side * 3 // 4
+    img = (rng.random((max(h // 24, 2), max(w // 24, 2), 3)) * 255).astype(np.uint8)
+    img = cv2.resize(img, (w, h), interpolation=cv2.INTER_NEAREST)
+    for _ in range(8):
+        x, y = int(rng.integers(0, w)), int(rng.integers(0, h))
+        cv2.rectangle(img, (x, y), (x + w // 6, y + h // 6), tuple(int(c) for c in rng.integers(0, 255, 3)), 3)
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+
+
+class FakeBotAPI:
+    """
+    delay : độ trễ (giây) thêm vào mỗi lời gọi API, mô phỏng mạng tới Telegram
+    flood : tỉ lệ sendMessage/editMessageText bị trả 429 (retry_after=1)
+    """
+
+    FLOOD_METHODS = ("sendMessage", "editMessageText")
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, flood=0.0, seed=0):
+        self.delay, self.flood = delay, flood
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._files = {}   # (seed, side) -> bytes
+        self._mid = 0
+        self.reset()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def do_GET(self):
+                api._get(self)
+
+            def do_POST(self):
+                api._post(self)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+            self.flooded = 0
+            self.bytes_served = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "flooded": self.flooded, "bytes_served": self.bytes_served}
+
+    def photo(self, file_id: str) -> bytes:
+        m = PHOTO_RX.match(file_id)
+        if not m:
+            raise KeyError(file_id)
+        key = (int(m.group(1)), int(m.group(2)))
+        b = self._files.get(key)
+        if b is None:
+            b = self._files[key] = make_jpeg(*key)
+        return b
+
+    def prepare(self, file_ids):
+        """Sinh trước ảnh (ngoài phần đo thời gian)."""
+        for fid in file_ids:
+            self.photo(fid)
+
+    # ---- HTTP ----
+    def _reply(self, h, code: int, payload, ctype="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        h.send_response(code)
+        h.send_header("Content-Type", ctype)
+        h.send_header("Content-Length", str(len(body)))
+        h.end_headers()
+        h.wfile.write(body)
+
+    def _params(self, h) -> dict:
+        n = int(h.headers.get("Content-Length") or 0)
+        raw = h.rfile.read(n) if n else b""
+        ctype = h.headers.get("Content-Type", "")
+        if "json" in ctype:
+            return json.loads(raw or b"{}")
+        if "x-www-form-urlencoded" in ctype:
+            return {k: v[0] for k, v in urllib.parse.parse_qs(raw.decode()).items()}
+        if "multipart" in ctype:
+            # sendDocument/sendPhoto: chỉ cần chat_id
+            m = re.search(rb'name="chat_id"\r\n\r\n([^\r]+)', raw)
+            return {"chat_id": m.group(1).decode()} if m else {}
+        return {}
+
+    def _get(self, h):
+        if h.path == "/_stats":
+            return self._reply(h, 200, self.stats())
+        if "/file/" in h.path:
+            fid = h.path.rsplit("/", 1)[-1]
+            try:
+                b = self.photo(fid)
+            except KeyError:
+                return self._reply(h, 404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            with self._lock:
+                self.bytes_served += len(b)
+            return self._reply(h, 200, b, ctype="image/jpeg")
+        self._reply(h, 404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+    def _post(self, h):
+        method = h.path.rsplit("/", 1)[-1]
+        p = self._params(h)
+        if method == "_reset":
+            self.reset()
+            return self._reply(h, 200, {"ok": True})
+        if method == "_prepare":
+            self.prepare(p.get("file_ids", []))
+            return self._reply(h, 200, {"ok": True})
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.calls[method] += 1
+            flood = method in self.FLOOD_METHODS and self.flood and self._rng.random() < self.flood
+            if flood:
+                self.flooded += 1
+        if flood:
+            return self._reply(h, 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                        "parameters": {"retry_after": 1}})
+        self._reply(h, 200, {"ok": True, "result": self._result(method, p)})
+
+    def _result(self, method: str, p: dict):
+        now = int(time.time())
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+        if method == "getFile":
+            fid = p.get("file_id", "")
+            try:
+                size = len(self.photo(fid))
+            except KeyError:
+                size = 0
+            return {"file_id": fid, "file_unique_id": "u" + fid, "file_size": size, "file_path": "photos/" + fid}
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            with self._lock:
+                self._mid += 1
+                mid = int(p.get("message_id") or 0) if method == "editMessageText" else self._mid
+            chat_id = int(p.get("chat_id") or 0)
+            return {"message_id": mid, "date": now, "chat": {"id": chat_id, "type": "group", "title": "bench"},
+                    "text": p.get("text", "")}
+        return True
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench.fake_api", description="Bot API giả lập cho benchmark")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--delay", type=float, default=0.0, help="độ trễ mỗi lời gọi API (giây)")
+    ap.add_argument("--flood", type=float, default=0.0, help="tỉ lệ sendMessage/editMessageText bị trả 429")
+    args = ap.parse_args(argv)
+    api = FakeBotAPI(args.host, args.port, delay=args.delay, flood=args.flood)
+    print(f"Bot API giả lập: {api.url}/bot<token>  (file: {api.url}/file/bot<token>)")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Micro-benchmark các kernel chấm điểm 5S (OpenCV, rule-based) trên bộ ảnh sinh sẵn ở nhiều độ phân giải.
+
+Mỗi kernel × cạnh dài ảnh: thời gian/lần gọi (median, mean, min, p95 — ms) và bộ nhớ cấp phát khi gọi
+(peak/net — KiB, đo bằng tracemalloc ở 1 lượt riêng để không làm lệch thời gian).
+Kernel nhận ảnh BGR chạy trên ImageCtx mới mỗi lần (gồm cả chuyển xám...); apply_scoring_* nhận bytes JPEG (gồm decode).
+
+    python -m bench.kernels --json kernels.json
+    python -m bench.kernels --baseline kernels.json [--fail-over 10]   # so với lần đo trước, chậm hơn 10% → exit 1
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_SIDES = (640, 1280, 2560, 4000)   # 1280 = bản ảnh Telegram; 4000 ≈ ảnh gốc điện thoại
+KV = "HangHoa"
+
+
+# ========= BỘ ẢNH =========
+def make_scene(seed: int, side: int):
+    """Ảnh BGR 4:3 giống ảnh kho: nền chuyển màu, kệ ngang, thùng hàng, vết bẩn, nhiễu + JPEG-like blur."""
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    w, h = side, side * 3 // 4
+    s = side / 1280.0
+    y = np.linspace(0, 1, h, dtype=np.float32)[:, None, None]
+    base = rng.integers(90, 200, 3).astype(np.float32)
+    img = (base * (0.75 + 0.5 * y) + np.zeros((1, w, 3), np.float32)).clip(0, 255).astype(np.uint8)
+    shelves = int(rng.integers(2, 5))
+    for k in range(shelves):
+        yy = int(h * (k + 1) / (shelves + 1) + rng.normal(0, 5 * s))
+        cv2.line(img, (0, yy), (w, yy + int(rng.normal(0, 8 * s))), (40, 40, 40), max(1, int(6 * s)))
+        x = int(rng.integers(0, int(30 * s) + 1))
+        while x < w:
+            bw, bh = int(rng.integers(60, 180) * s), int(rng.integers(40, 120) * s)
+            color = tuple(int(c) for c in rng.integers(30, 230, 3))
+            cv2.rectangle(img, (x, yy - bh), (x + bw, yy), color, -1)
+            cv2.rectangle(img, (x, yy - bh), (x + bw, yy), (20, 20, 20), max(1, int(2 * s)))
+            x += bw + int(rng.integers(5, 60) * s)
+    for _ in range(int(rng.integers(3, 10))):
+        c = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+        cv2.circle(img, c, int(rng.integers(5, 40) * s), (int(rng.integers(20, 80)),) * 3, -1)
+    noise = rng.normal(0, 6, img.shape).astype(np.int16)
+    img = (img.astype(np.int16) + noise).clip(0, 255).astype(np.uint8)
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+def build_corpus(sides, images: int, seed: int) -> dict:
+    """cạnh dài -> [(ảnh BGR, bytes JPEG)]"""
+    import cv2
+    corpus = {}
+    for side in sides:
+        items = []
+        for i in range(images):
+            img = make_scene(seed * 1000 + i, side)
+            items.append((img, cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()))
+        corpus[side] = items
+    return corpus
+
+
+# ========= KERNEL =========
+def kernels(bot) -> dict:
+    """tên -> (hàm nhận (ảnh BGR, bytes JPEG))"""
+    fresh = lambda img: bot.ImageCtx(img_bgr=img)
+    return {
+        "_score_quality_components": lambda img, b: bot._score_quality_components(fresh(img)),
+        "_score_hanghoa": lambda img, b: bot._score_hanghoa(fresh(img)),
+        "_score_wc": lambda img, b: bot._score_wc(fresh(img)),
+        "_score_khobai": lambda img, b: bot._score_khobai(fresh(img)),
+        "_score_vanphong": lambda img, b: bot._score_vanphong(fresh(img)),
+        "_phash_cv": lambda img, b: bot._phash_cv(fresh(img)),
+        "apply_scoring_rule": lambda img, b: bot.apply_scoring_rule(b, KV),
+        "apply_scoring_struct": lambda img, b: bot.apply_scoring_struct(b, KV, False, "bench|0", "01/01/2026"),
+    }
+
+def measure(fn, items, repeat: int) -> dict:
+    for img, b in items[:1]:
+        fn(img, b)  # làm nóng (import, cache của OpenCV)
+    times = []
+    for _ in range(repeat):
+        for img, b in items:
+            t0 = time.perf_counter()
+            fn(img, b)
+            times.append(time.perf_counter() - t0)
+    peaks, nets = [], []
+    tracemalloc.start()
+    try:
+        for img, b in items:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(img, b)
+            cur, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            nets.append(cur - before)
+    finally:
+        tracemalloc.stop()
+    times.sort()
+    return {
+        "n": len(times),
+        "median_ms": statistics.median(times) * 1000,
+        "mean_ms": statistics.fmean(times) * 1000,
+        "min_ms": times[0] * 1000,
+        "p95_ms": times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))] * 1000,
+        "peak_kib": max(peaks) / 1024,
+        "net_kib": max(nets) / 1024,
+    }
+
+def run(args) -> dict:
+    import bot
+    import cv2
+    import numpy as np
+    if args.cv_threads is not None:
+        cv2.setNumThreads(args.cv_threads)
+    table = kernels(bot)
+    names = args.kernels or list(table)
+    unknown = [n for n in names if n not in table]
+    if unknown:
+        raise SystemExit(f"kernel không có: {', '.join(unknown)} (chọn trong {', '.join(table)})")
+    corpus = build_corpus(args.sides, args.images, args.seed)
+    results = {}
+    for side, items in corpus.items():
+        for name in names:
+            r = measure(table[name], items, args.repeat)
+            results[f"{name}@{side}"] = {"kernel": name, "side": side, **r}
+            print(f"{name:28s}{side:6d}{r['median_ms']:10.2f}{r['p95_ms']:10.2f}{r['peak_kib']:12.0f}", flush=True)
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "cv_threads": cv2.getNumThreads(),
+            "images": args.images, "repeat": args.repeat, "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+# ========= SO SÁNH =========
+def compare(cur: dict, base: dict, fail_over: float | None) -> int:
+    """In chênh lệch so với baseline; trả về số kernel chậm hơn ngưỡng fail_over (%)."""
+    print(f"\n{'kernel@cạnh':36s}{'median ms':>12s}{'baseline':>10s}{'Δ%':>8s}{'peak KiB':>10s}{'Δ%':>8s}")
+    slower = 0
+    for key, r in cur["results"].items():
+        b = base.get("results", {}).get(key)
+        if not b:
+            print(f"{key:36s}{r['median_ms']:12.2f}{'-':>10s}")
+            continue
+        dt = (r["median_ms"] / b["median_ms"] - 1) * 100 if b["median_ms"] else 0.0
+        dm = (r["peak_kib"] / b["peak_kib"] - 1) * 100 if b["peak_kib"] else 0.0
+        flag = ""
+        if fail_over is not None and dt > fail_over:
+            slower += 1
+            flag = "  ✗"
+        print(f"{key:36s}{r['median_ms']:12.2f}{b['median_ms']:10.2f}{dt:+8.1f}{r['peak_kib']:10.0f}{dm:+8.1f}{flag}")
+    return slower
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench.kernels", description="Micro-benchmark kernel chấm điểm 5S")
+    ap.add_argument("--sides", type=lambda s: [int(x) for x in s.split(",")], default=list(DEFAULT_SIDES),
+                    help="các cạnh dài ảnh (px), vd. 640,1280,4000")
+    ap.add_argument("--images", type=int, default=4, help="số ảnh mỗi độ phân giải")
+    ap.add_argument("--repeat", type=int, default=5, help="số lượt đo mỗi ảnh")
+    ap.add_argument("--kernels", type=lambda s: s.split(","), help="chỉ đo các kernel này (phân cách bằng dấu phẩy)")
+    ap.add_argument("--cv-threads", type=int, help="cv2.setNumThreads (mặc định: để OpenCV tự chọn)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="ghi kết quả ra file JSON")
+    ap.add_argument("--baseline", help="file JSON của lần đo trước để so sánh")
+    ap.add_argument("--fail-over", type=float, help="exit 1 nếu median kernel nào chậm hơn baseline quá X%%")
+    args = ap.parse_args(argv)
+
+    # apply_scoring_struct cần bật chấm điểm; pHash INDEX ghi vào thư mục tạm, không đụng dữ liệu thật
+    tmp = tempfile.TemporaryDirectory(prefix="bench5s-")
+    os.environ["SCORING_ENABLED"] = "1"
+    os.environ["PHASH_DB_PATH"] = os.path.join(tmp.name, "phashes.bin")
+    sys.path.insert(0, str(ROOT))
+    print(f"{'kernel':28s}{'cạnh':>6s}{'median':>10s}{'p95':>10s}{'peak KiB':>12s}")
+    with tmp:
+        cur = run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(cur, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            base = json.load(f)
+        if compare(cur, base, args.fail_over):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
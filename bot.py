@@ -18,51 +18,548 @@
 
 import os
 import re
+import sys
 import json
+import shutil
 import hashlib
-from datetime import datetime, date, time as dtime
+import asyncio
+import bisect
+import functools
+import glob
+import logging
+import logging.handlers
+import queue
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+from collections import Counter
+from datetime import datetime, date, timedelta, time as dtime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from zoneinfo import ZoneInfo
 
-import pandas as pd
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
     ApplicationBuilder, Application, CommandHandler, MessageHandler,
-    ContextTypes, filters
+    TypeHandler, ContextTypes, JobQueue, filters
 )
 
 
 
-# === Safe Telegram send helpers (retry khi mạng chậm) ===
-import asyncio
-from telegram.error import TimedOut, RetryAfter, NetworkError
+# ========= METRICS (thời gian từng bước + bộ đếm, xuất dạng Prometheus) =========
+# span("bước") đo thời gian 1 bước (get_file, tải ảnh, MD5, ghi DB, chấm điểm, tin tiến độ...) vào histogram trong RAM;
+# inc("tên", nhãn=...) tăng bộ đếm (ảnh nhận/trùng/quá khứ...). Không cần thư viện ngoài.
+# METRICS_PORT > 0: mở http://METRICS_HOST:METRICS_PORT/metrics (mặc định chỉ nghe 127.0.0.1).
+# ADMIN_USER_IDS: user id (phân cách dấu phẩy) được dùng lệnh quản trị (/stats...).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+ADMIN_USER_IDS = [int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x]
+
+_MET_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_MET_LOCK = threading.Lock()
+_HISTS = {}       # (tên, nhãn) -> [số lần theo bucket (cuối = +Inf), tổng giây, số lần]
+_COUNTERS = {}    # (tên, nhãn) -> giá trị
+_COLLECTORS = {}  # tên -> (kiểu, hàm trả về số hoặc {nhãn: số}), đọc lúc xuất
+_METRICS_SERVER = None
+STARTED_AT = time.time()
+
+def _labels(kw: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in kw.items()))
+
+def observe(name: str, seconds: float, **labels):
+    key = (name, _labels(labels))
+    with _MET_LOCK:
+        h = _HISTS.get(key)
+        if h is None:
+            h = _HISTS[key] = [[0] * (len(_MET_BUCKETS) + 1), 0.0, 0]
+        h[0][bisect.bisect_left(_MET_BUCKETS, seconds)] += 1
+        h[1] += seconds
+        h[2] += 1
+
+def inc(name: str, n: int = 1, **labels):
+    key = (name, _labels(labels))
+    with _MET_LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + n
+
+def register_collector(name: str, fn, kind: str = "gauge"):
+    """Số liệu lấy lúc xuất (kích thước hàng đợi, cache...): fn() -> số hoặc {(("nhãn", "giá trị"),): số}."""
+    _COLLECTORS[name] = (kind, fn)
+
+class span:
+    """`with span("md5"):` — ghi thời gian khối lệnh (kể cả khi lỗi) vào bot5s_stage_seconds{stage=...}."""
+    __slots__ = ("stage", "labels", "t0")
+
+    def __init__(self, stage: str, **labels):
+        self.stage, self.labels = stage, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("bot5s_stage_seconds", time.perf_counter() - self.t0, stage=self.stage, **self.labels)
+        return False
+
+def timed(stage: str):
+    """Decorator cho hàm async: cả hàm là 1 span."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*a, **kw):
+            with span(stage):
+                return await fn(*a, **kw)
+        return wrapper
+    return deco
+
+def hist_quantile(buckets: list, q: float) -> float:
+    """Ước lượng phân vị từ bucket (nội suy tuyến tính trong bucket, như histogram_quantile của Prometheus)."""
+    total = sum(buckets)
+    if not total:
+        return 0.0
+    rank, cum = q * total, 0
+    for i, c in enumerate(buckets):
+        if c and cum + c >= rank:
+            lo = _MET_BUCKETS[i - 1] if i > 0 else 0.0
+            if i == len(_MET_BUCKETS):
+                return lo  # +Inf: trả về cận dưới
+            return lo + (_MET_BUCKETS[i] - lo) * (rank - cum) / c
+        cum += c
+    return _MET_BUCKETS[-1]
+
+def metrics_snapshot() -> tuple:
+    with _MET_LOCK:
+        hists = {k: (list(v[0]), v[1], v[2]) for k, v in _HISTS.items()}
+        counters = dict(_COUNTERS)
+    collected = {}
+    for name, (kind, fn) in _COLLECTORS.items():
+        try:
+            val = fn()
+        except Exception:
+            continue
+        collected[name] = (kind, val if isinstance(val, dict) else {(): val})
+    return hists, counters, collected
+
+def _fmt_labels(lb: tuple, extra: tuple = ()) -> str:
+    items = lb + extra
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+def metrics_text() -> str:
+    """Toàn bộ số liệu theo định dạng text của Prometheus."""
+    hists, counters, collected = metrics_snapshot()
+    out = ["# TYPE bot5s_uptime_seconds gauge", f"bot5s_uptime_seconds {time.time() - STARTED_AT:.0f}"]
+    for name in sorted({k[0] for k in counters}):
+        out.append(f"# TYPE {name} counter")
+        out += [f"{name}{_fmt_labels(lb)} {v}" for (n, lb), v in sorted(counters.items()) if n == name]
+    for name in sorted({k[0] for k in hists}):
+        out.append(f"# TYPE {name} histogram")
+        for (n, lb), (buckets, total, count) in sorted(hists.items()):
+            if n != name:
+                continue
+            cum = 0
+            for le, c in zip(_MET_BUCKETS + ("+Inf",), buckets):
+                cum += c
+                out.append(f"{name}_bucket{_fmt_labels(lb, (('le', str(le)),))} {cum}")
+            out.append(f"{name}_sum{_fmt_labels(lb)} {total:.6f}")
+            out.append(f"{name}_count{_fmt_labels(lb)} {count}")
+    for name, (kind, vals) in sorted(collected.items()):
+        out.append(f"# TYPE {name} {kind}")
+        out += [f"{name}{_fmt_labels(lb)} {v}" for lb, v in sorted(vals.items())]
+    return "\n".join(out) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *a):
+        pass
 
-async def _retry_async(coro_func, *args, **kwargs):
-    """
-    Retry tối đa 1 lần:
-    - RetryAfter: ngủ số giây Telegram yêu cầu rồi thử lại.
-    - TimedOut/NetworkError: ngủ 1s rồi thử lại.
-    """
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server():
+    """HTTP server /metrics ở thread nền (1 lần cho cả process, các vòng restart dùng lại)."""
+    global _METRICS_SERVER
+    if METRICS_PORT <= 0 or _METRICS_SERVER is not None:
+        return
+    _METRICS_SERVER = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+    _METRICS_SERVER.daemon_threads = True
+    threading.Thread(target=_METRICS_SERVER.serve_forever, name="metrics", daemon=True).start()
+    logging.info("Metrics: http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+# ========= WATCHDOG EVENT LOOP (phát hiện code đồng bộ chặn loop) =========
+# Task nhịp tim chạy trên event loop mỗi LOOP_LAG_INTERVAL giây, thread watchdog theo dõi nhịp tim.
+# Loop không phản hồi quá LOOP_LAG_THRESHOLD giây → ghi stack của luồng event loop (chỉ ra đúng dòng code đang chặn),
+# task và update/job đang xử lý vào LOOP_LAG_LOG (xoay vòng LOOP_LAG_LOG_MB MB × 3 file). LOOP_LAG_THRESHOLD=0 → tắt.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.5"))
+LOOP_LAG_LOG = os.getenv("LOOP_LAG_LOG", "loop_lag.log")
+LOOP_LAG_LOG_MB = float(os.getenv("LOOP_LAG_LOG_MB", "5"))
+
+_WD = {"loop": None, "thread_id": None, "beat": None, "task": None, "thread": None, "log": None}
+_TASK_WORK = weakref.WeakKeyDictionary()  # asyncio.Task -> việc đang làm (update/job), tự mất khi task xong
+
+def watch_current(desc: str):
+    """Ghi lại task hiện tại đang làm gì (update/job) để watchdog in ra khi loop bị chặn."""
+    task = asyncio.current_task()
+    if task is not None:
+        _TASK_WORK[task] = desc
+
+def describe_update(update) -> str:
+    msg = update.effective_message
+    parts = [f"update {update.update_id}"]
+    if update.effective_chat:
+        parts.append(f"chat={update.effective_chat.id}")
+    if update.effective_user:
+        parts.append(f"user={update.effective_user.id}")
+    if msg is not None:
+        if msg.photo:
+            parts.append("ảnh")
+        if msg.media_group_id:
+            parts.append(f"album={msg.media_group_id}")
+        text = msg.text or msg.caption
+        if text:
+            parts.append(repr(text[:80]))
+    return " ".join(parts)
+
+async def watch_update(update, context):
+    watch_current(describe_update(update))
+
+def _wd_logger() -> logging.Logger:
+    if _WD["log"] is None:
+        log = logging.getLogger("bot5s.loop_lag")
+        h = logging.handlers.RotatingFileHandler(LOOP_LAG_LOG, maxBytes=int(LOOP_LAG_LOG_MB * 1024 * 1024),
+                                                 backupCount=3, encoding="utf-8")
+        h.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        log.addHandler(h)
+        log.setLevel(logging.INFO)
+        log.propagate = False
+        _WD["log"] = log
+    return _WD["log"]
+
+def _dump_stall(lag: float):
+    inc("bot5s_loop_stalls_total")
+    loop, tid = _WD["loop"], _WD["thread_id"]
+    frame = sys._current_frames().get(tid)
+    current = getattr(asyncio.tasks, "_current_tasks", {})  # task đang chạy của từng loop (asyncio nội bộ)
+    task = current.get(loop) if loop is not None else None
+    work = _TASK_WORK.get(task, "(không rõ)") if task is not None else "(callback ngoài task)"
+    lines = [f"=== Event loop bị chặn {lag:.2f}s (ngưỡng {LOOP_LAG_THRESHOLD:g}s) ==="]
+    if task is not None:
+        lines.append(f"Task: {task.get_name()} · {task.get_coro()!r}")
+    lines.append(f"Đang xử lý: {work}")
+    lines.append("Stack luồng event loop:")
+    lines.append("".join(traceback.format_stack(frame)).rstrip() if frame is not None else "(không lấy được)")
+    _wd_logger().warning("\n".join(lines))
+    logging.warning("Event loop bị chặn %.2fs · %s (stack: %s)", lag, work, LOOP_LAG_LOG)
+
+def _watchdog_run():
+    stalled = None  # nhịp tim lúc phát hiện bị chặn (mỗi lần chặn chỉ ghi 1 lần)
+    while True:
+        time.sleep(LOOP_LAG_INTERVAL)
+        beat = _WD["beat"]
+        if beat is None:
+            stalled = None
+            continue
+        lag = time.monotonic() - beat - LOOP_LAG_INTERVAL
+        if lag >= LOOP_LAG_THRESHOLD:
+            if stalled != beat:
+                stalled = beat
+                try:
+                    _dump_stall(lag)
+                except Exception:
+                    logging.exception("Watchdog: lỗi ghi stack")
+        elif stalled is not None and beat != stalled:
+            _wd_logger().info("Event loop chạy lại sau %.2fs", beat - stalled - LOOP_LAG_INTERVAL)
+            stalled = None
+
+async def _loop_heartbeat():
+    _WD["loop"], _WD["thread_id"] = asyncio.get_running_loop(), threading.get_ident()
     try:
-        return await coro_func(*args, **kwargs)
-    except RetryAfter as e:
-        await asyncio.sleep(getattr(e, "retry_after", 2))
-        return await coro_func(*args, **kwargs)
-    except (TimedOut, NetworkError):
-        await asyncio.sleep(1)
-        return await coro_func(*args, **kwargs)
+        while True:
+            t = time.monotonic()
+            _WD["beat"] = t
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            observe("bot5s_loop_lag_seconds", max(0.0, time.monotonic() - t - LOOP_LAG_INTERVAL))
+    finally:
+        _WD["beat"] = None
+
+def start_watchdog():
+    """Gọi trên event loop (post_init). Thread watchdog tạo 1 lần, task nhịp tim tạo lại mỗi vòng restart."""
+    if LOOP_LAG_THRESHOLD <= 0:
+        return
+    if _WD["thread"] is None:
+        _WD["thread"] = threading.Thread(target=_watchdog_run, name="loop-watchdog", daemon=True)
+        _WD["thread"].start()
+    if _WD["task"] is None or _WD["task"].done():
+        _WD["task"] = asyncio.get_running_loop().create_task(_loop_heartbeat())
+
+def stop_watchdog():
+    task, _WD["task"] = _WD["task"], None
+    _WD["beat"] = None
+    if task is not None:
+        task.cancel()
+
+# === Safe Telegram send helpers (hàng đợi gửi tin: ưu tiên + giới hạn tốc độ) ===
+# Mọi tin gửi ra Telegram đi qua OUTBOX:
+# - Ưu tiên: xác nhận ảnh (PRIO_ACK) > cảnh báo/báo cáo (PRIO_NOTICE) > điểm 5S (PRIO_SCORING)
+# - Token bucket theo từng chat (SEND_CHAT_RATE tin/giây, SEND_CHAT_BURST) và toàn bot (SEND_GLOBAL_RATE)
+# - RetryAfter: chặn chat đó đúng số giây Telegram yêu cầu rồi gửi lại (không bỏ tin)
+# - TimedOut/NetworkError: thử lại tối đa SEND_RETRIES lần; BadRequest (tin đã xoá, sai tham số...) là lỗi cố định → không thử lại
+# Telegram cho mỗi group khoảng 20 tin/phút (tính cả sửa tin) → mặc định 0.33 tin/giây/group, dồn tối đa 3 tin.
+# - Tin có `key` (vd. tin tiến độ của 1 kho/ngày): nhiều lần cập nhật chưa kịp gửi gộp thành 1 lần gửi nội dung mới nhất
+import itertools
+from telegram.error import TimedOut, RetryAfter, NetworkError, BadRequest
+
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "0.33"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "3"))
+
+PRIO_ACK, PRIO_NOTICE, PRIO_SCORING = 0, 1, 2
+_PRIO_NAMES = {PRIO_ACK: "ack", PRIO_NOTICE: "notice", PRIO_SCORING: "scoring"}
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, max(1.0, burst)
+        self.tokens, self.ts = self.burst, None
+
+    def _refill(self, now: float):
+        if self.ts is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def wait_time(self, now: float) -> float:
+        """Số giây phải chờ tới khi có 1 token (0 = gửi được ngay; rate <= 0 = không giới hạn)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+class _OutJob:
+    __slots__ = ("priority", "seq", "chat_id", "fn", "key", "fut", "not_before", "tries", "t0")
+
+    def __init__(self, priority, seq, chat_id, fn, key, fut):
+        self.priority, self.seq, self.chat_id, self.fn, self.key, self.fut = priority, seq, chat_id, fn, key, fut
+        self.not_before = 0.0
+        self.tries = 0
+        self.t0 = time.perf_counter()  # lúc xếp hàng (đo thời gian chờ gửi)
+
+class _ChatState:
+    __slots__ = ("bucket", "busy", "blocked_until")
+
+    def __init__(self, rate, burst):
+        self.bucket = _TokenBucket(rate, burst)
+        self.busy = False          # mỗi chat chỉ 1 request đang bay → giữ đúng thứ tự tin trong chat
+        self.blocked_until = 0.0   # hạn RetryAfter
+
+class OutboundScheduler:
+    """Hàng đợi gửi tin ra Telegram (1 task điều phối trên event loop của bot)."""
+
+    def __init__(self, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 global_rate=SEND_GLOBAL_RATE, retries=SEND_RETRIES):
+        self.chat_rate, self.chat_burst, self.retries = chat_rate, chat_burst, retries
+        self._global = _TokenBucket(global_rate, global_rate)
+        self._jobs = []     # job chờ gửi (ít, quét tuyến tính)
+        self._keyed = {}    # key -> job chưa gửi (để gộp)
+        self._chats = {}    # chat_id -> _ChatState
+        self._running = set()
+        self._seq = itertools.count()
+        self._loop = self._task = self._wake = None
+        self.stats = {"sent": 0, "coalesced": 0, "retry_after": 0, "retried": 0, "failed": 0}
+
+    def _ensure(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # vòng lặp mới (restart bot): job của loop cũ không còn ai chờ
+            self._loop, self._jobs, self._keyed, self._running = loop, [], {}, set()
+            self._chats = {}
+            self._wake = asyncio.Event()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    def submit(self, chat_id, fn, priority: int = PRIO_NOTICE, key=None) -> asyncio.Future:
+        """
+        Xếp 1 lần gọi API vào hàng đợi. `fn` là hàm không tham số trả về coroutine, được gọi
+        đúng lúc gửi (và mỗi lần gửi lại). Trả về Future mang kết quả của lần gọi thành công.
+        """
+        self._ensure()
+        if key is not None:
+            job = self._keyed.get(key)
+            if job is not None:
+                job.fn = fn
+                job.priority = min(job.priority, priority)
+                self.stats["coalesced"] += 1
+                return job.fut
+        fut = self._loop.create_future()
+        fut.add_done_callback(_outbox_log_failure)
+        job = _OutJob(priority, next(self._seq), chat_id, fn, key, fut)
+        self._enqueue(job)
+        return fut
+
+    def _enqueue(self, job: _OutJob):
+        if job.key is not None:
+            newer = self._keyed.get(job.key)
+            if newer is not None:
+                # đã có lần cập nhật mới hơn cho cùng key → lần đó gửi thay, chung kết quả
+                newer.fut.add_done_callback(lambda f, old=job.fut: _future_copy(f, old))
+                return
+            self._keyed[job.key] = job
+        self._jobs.append(job)
+        self._wake.set()
+
+    def _chat(self, chat_id) -> _ChatState:
+        st = self._chats.get(chat_id)
+        if st is None:
+            st = self._chats[chat_id] = _ChatState(self.chat_rate, self.chat_burst)
+        return st
+
+    def _pick(self, now: float):
+        best, wait = None, None
+        for job in self._jobs:
+            st = self._chat(job.chat_id)
+            if st.busy:
+                continue  # gửi xong sẽ đánh thức lại
+            ready_at = max(job.not_before, st.blocked_until, now + st.bucket.wait_time(now))
+            if ready_at <= now:
+                if best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                    best = job
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return best, wait
+
+    async def _run(self):
+        loop = self._loop
+        while True:
+            now = loop.time()
+            job, wait = self._pick(now)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            gwait = self._global.wait_time(now)
+            if gwait > 0:
+                await asyncio.sleep(gwait)
+                continue
+            self._global.take(now)
+            st = self._chat(job.chat_id)
+            st.bucket.take(now)
+            st.busy = True
+            self._jobs.remove(job)
+            if job.key is not None and self._keyed.get(job.key) is job:
+                del self._keyed[job.key]
+            t = loop.create_task(self._send(job, st))
+            self._running.add(t)
+            t.add_done_callback(self._running.discard)
+
+    async def _send(self, job: _OutJob, st: _ChatState):
+        prio = _PRIO_NAMES.get(job.priority, str(job.priority))
+        if job.t0 is not None:  # chỉ lần gửi đầu (gửi lại sau RetryAfter/lỗi mạng không tính)
+            observe("bot5s_outbox_wait_seconds", time.perf_counter() - job.t0, priority=prio)
+            job.t0 = None
+        try:
+            with span("telegram_send", priority=prio):
+                res = await job.fn()
+        except RetryAfter as e:
+            st.blocked_until = self._loop.time() + float(getattr(e, "retry_after", 2) or 2)
+            self.stats["retry_after"] += 1
+            self._enqueue(job)
+        except BadRequest as e:  # lớp con của NetworkError nhưng gửi lại cũng lỗi y như vậy
+            self.stats["failed"] += 1
+            if not job.fut.done():
+                job.fut.set_exception(e)
+        except (TimedOut, NetworkError) as e:
+            job.tries += 1
+            if job.tries <= self.retries:
+                job.not_before = self._loop.time() + min(2 ** (job.tries - 1), 10)
+                self.stats["retried"] += 1
+                self._enqueue(job)
+            else:
+                self.stats["failed"] += 1
+                if not job.fut.done():
+                    job.fut.set_exception(e)
+        except Exception as e:
+            self.stats["failed"] += 1
+            if not job.fut.done():
+                job.fut.set_exception(e)
+        else:
+            self.stats["sent"] += 1
+            if not job.fut.done():
+                job.fut.set_result(res)
+        finally:
+            st.busy = False
+            self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._jobs) + len(self._running)
+
+    async def drain(self, timeout: float = 10.0):
+        """Chờ gửi hết hàng đợi (dùng khi tắt bot), quá timeout thì bỏ."""
+        if self._loop is not asyncio.get_running_loop():
+            return
+        deadline = self._loop.time() + timeout
+        while self.pending() and self._loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+def _future_copy(src: asyncio.Future, dst: asyncio.Future):
+    if dst.done():
+        return
+    if src.cancelled():
+        dst.cancel()
+    elif src.exception() is not None:
+        dst.set_exception(src.exception())
+    else:
+        dst.set_result(src.result())
+
+def _outbox_log_failure(fut: asyncio.Future):
+    # lấy exception ra để tin gửi kiểu "bắn rồi quên" không sinh cảnh báo asyncio
+    if not fut.cancelled() and fut.exception() is not None:
+        logging.warning("Gửi tin Telegram thất bại: %r", fut.exception())
+
+OUTBOX = OutboundScheduler()
 
-async def safe_send_message(bot, chat_id, text, **kwargs):
-    return await _retry_async(bot.send_message, chat_id=chat_id, text=text, **kwargs)
+async def safe_send_message(bot, chat_id, text, priority: int = PRIO_NOTICE, **kwargs):
+    return await OUTBOX.submit(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
 
-async def safe_send_photo(bot, chat_id, photo, **kwargs):
-    return await _retry_async(bot.send_photo, chat_id=chat_id, photo=photo, **kwargs)
+async def safe_send_photo(bot, chat_id, photo, priority: int = PRIO_NOTICE, **kwargs):
+    return await OUTBOX.submit(chat_id, lambda: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs), priority)
 
-async def safe_send_document(bot, chat_id, document, **kwargs):
-    return await _retry_async(bot.send_document, chat_id=chat_id, document=document, **kwargs)
+async def safe_send_document(bot, chat_id, document, priority: int = PRIO_NOTICE, **kwargs):
+    return await OUTBOX.submit(chat_id, lambda: bot.send_document(chat_id=chat_id, document=document, **kwargs), priority)
 
-async def safe_edit_message_text(bot, chat_id, message_id, text, **kwargs):
-    return await _retry_async(bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+async def safe_edit_message_text(bot, chat_id, message_id, text, priority: int = PRIO_NOTICE, **kwargs):
+    return await OUTBOX.submit(
+        chat_id, lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs), priority)
+
+def safe_reply_text(msg, text, priority: int = PRIO_ACK, **kwargs) -> asyncio.Future:
+    """
+    Xếp tin trả lời vào OUTBOX rồi trả về ngay (không chờ giới hạn tốc độ): handler không giữ slot
+    CONCURRENT_UPDATES/khoá kho trong lúc chờ gửi. Lỗi gửi được _outbox_log_failure ghi log.
+    """
+    return OUTBOX.submit(msg.chat_id, lambda: msg.reply_text(text, **kwargs), priority)
 # === End helpers ===
 
 # === Helper: hiển thị tên kho + mã kho an toàn (không lỗi nếu kho_map chưa có) ===
@@ -78,10 +575,29 @@ def get_kho_display(id_kho):
 # === End helper kho display ===
 
 # ===== Scoring imports & ENV =====
-import cv2
-import numpy as np
+# OpenCV/NumPy nặng (vài chục MB RAM, ~0.5s import): chỉ nạp ở lần đầu thật sự dùng
+# (bật chấm điểm, worker chấm điểm, pHash index). Tắt chấm điểm thì bot không import 2 thư viện này.
+import importlib
 import random, time
 
+class _LazyModule:
+    """Module nạp ở lần truy cập thuộc tính đầu tiên, rồi biến toàn cục được thay bằng module thật."""
+
+    def __init__(self, module: str, alias: str):
+        self._module, self._alias = module, alias
+
+    def __getattr__(self, attr):
+        mod = importlib.import_module(self._module)
+        globals()[self._alias] = mod
+        return getattr(mod, attr)
+
+cv2 = _LazyModule("cv2", "cv2")
+np = _LazyModule("numpy", "np")
+
+def _import_cv():
+    """Nạp ngay OpenCV + NumPy (khởi tạo worker chấm điểm)."""
+    return cv2.__version__, np.__version__
+
 SCORING_ENABLED = os.getenv("SCORING_ENABLED","0") == "1"
 SCORING_MODE = os.getenv("SCORING_MODE","rule").strip().lower() or "rule"
 # Default weights per area
@@ -133,11 +649,106 @@ TEXT_PAIR_TIMEOUT = 120                       # giây: giữ caption/text dùng
 REQUIRED_PHOTOS = int(os.getenv("REQUIRED_PHOTOS", "4"))
 # Cố định group nhận báo cáo (có thể override bằng ENV REPORT_CHAT_IDS)
 DEFAULT_REPORT_CHAT_IDS = [-1002688907477]
+# Bot API server riêng (Local Bot API / server giả lập khi benchmark); để trống = api.telegram.org
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").strip()
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL", "").strip()
+
+
+# ========= BỘ NHỚ TẠM CÓ HẠN (TTL + LRU) =========
+# Mọi trạng thái tạm trong RAM (tin tiến độ, job hẹn giờ, caption album...) nằm trong TTLCache:
+# mỗi khoá sống `ttl` giây kể từ lần ghi cuối; vượt `max_size` thì bỏ khoá lâu không dùng nhất.
+# Job sweep_caches_job dọn định kỳ (CACHE_SWEEP_INTERVAL giây); cache_stats() cho số khoá/số lần bị bỏ.
+from collections import OrderedDict
+
+CACHE_SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_INTERVAL", "300"))
+CACHES = {}  # tên -> TTLCache
+
+class TTLCache:
+    """dict có hạn dùng (TTL) + giới hạn số khoá (LRU); default_factory như defaultdict."""
+
+    def __init__(self, name: str, ttl: float, max_size: int = 10000, default_factory=None):
+        self.name, self.ttl, self.max_size, self.default_factory = name, ttl, max_size, default_factory
+        self._data = OrderedDict()  # key -> [value, hạn (monotonic)]
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+        CACHES[name] = self
+
+    def _entry(self, key, now=None):
+        ent = self._data.get(key)
+        if ent is None:
+            return None
+        if ent[1] <= (time.monotonic() if now is None else now):
+            del self._data[key]
+            self.evicted_ttl += 1
+            return None
+        self._data.move_to_end(key)
+        return ent
+
+    def get(self, key, default=None):
+        ent = self._entry(key)
+        return default if ent is None else ent[0]
+
+    def __contains__(self, key) -> bool:
+        return self._entry(key) is not None
+
+    def __getitem__(self, key):
+        ent = self._entry(key)
+        if ent is not None:
+            return ent[0]
+        if self.default_factory is None:
+            raise KeyError(key)
+        value = self[key] = self.default_factory()
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = [value, time.monotonic() + self.ttl]
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evicted_lru += 1
+
+    def setdefault(self, key, default=None):
+        ent = self._entry(key)
+        if ent is not None:
+            return ent[0]
+        self[key] = default
+        return default
 
+    def pop(self, key, default=None):
+        ent = self._data.pop(key, None)
+        if ent is None:
+            return default
+        if ent[1] <= time.monotonic():
+            self.evicted_ttl += 1
+            return default
+        return ent[0]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def sweep(self) -> int:
+        """Bỏ mọi khoá đã hết hạn, trả về số khoá bị bỏ."""
+        now = time.monotonic()
+        expired = [k for k, ent in self._data.items() if ent[1] <= now]
+        for k in expired:
+            del self._data[k]
+        self.evicted_ttl += len(expired)
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "evicted_ttl": self.evicted_ttl, "evicted_lru": self.evicted_lru}
+
+def cache_stats() -> dict:
+    return {name: c.stats() for name, c in CACHES.items()}
+
+async def sweep_caches_job(context: ContextTypes.DEFAULT_TYPE):
+    removed = sum(c.sweep() for c in CACHES.values())
+    if removed:
+        logging.debug("Dọn cache: bỏ %d khoá hết hạn · %s", removed, cache_stats())
 
 # ========= CẢNH BÁO TRỄ (6s) =========
 # Lưu job cảnh báo theo (chat_id, id_kho, day_key) để tránh spam khi gửi liên tiếp
-WARN_JOBS = {}  # {(chat_id, id_kho, day_key): Job}
+WARN_JOBS = TTLCache("warn_jobs", ttl=600)  # {(chat_id, id_kho, day_key): Job}
 
 # ========= SCORING: helper to compact message & delayed send (5s) =========
 def compact_scoring_text(full_md: str) -> str:
@@ -158,7 +769,7 @@ async def _send_scoring_job(context: ContextTypes.DEFAULT_TYPE):
     text = data.get("text")
     if chat_id and text:
         try:
-            await safe_send_message(context.bot, chat_id=chat_id, text=text)
+            await safe_send_message(context.bot, chat_id=chat_id, text=text, priority=PRIO_SCORING)
         except Exception:
             pass
 
@@ -168,47 +779,179 @@ def _day_key(d):
 
 
 # ==== GỘP TIN NHẮN CHẤM ĐIỂM (AGGREGATE) ====
-from collections import defaultdict
 
 # ---- Duplicate similarity tracking (pHash) ----
 def _phash_cv(img_bgr):
-    import cv2, numpy as np
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    """img_bgr: ảnh BGR hoặc ImageCtx (dùng lại ảnh xám đã tính)."""
+    gray = _as_ctx(img_bgr).gray
     small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
     dct = cv2.dct(np.float32(small))
     block = dct[:8, :8]
     med = np.median(block[1:])
-    bits = (block > med).flatten()
-    h = 0
-    for b in bits:
-        h = (h << 1) | int(bool(b))
-    return int(h) & ((1<<64)-1)
+    # 64 bit → 8 byte (bit đầu là bit cao nhất) → 1 số uint64 big-endian
+    return int(np.packbits(block > med).view(">u8")[0])
 
 def _hamming64(a: int, b: int) -> int:
-    return int(bin((a ^ b) & ((1<<64)-1)).count("1"))
-
-from collections import deque
-DUP_HISTORY = {}  # key: f"{chat_id}|{id_kho}" -> deque[(phash:int, ngay_str:str)]
-_DUP_MAX = 60
+    return ((a ^ b) & ((1<<64)-1)).bit_count()
+
+_POPCNT8 = None  # bảng số bit 1 của 1 byte (tạo ở lần dùng đầu)
+
+def popcount64(x) -> "np.ndarray":
+    """Số bit 1 của từng phần tử mảng uint64 (vector hoá, không vòng lặp Python)."""
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(x).astype(np.int32)
+    global _POPCNT8
+    if _POPCNT8 is None:
+        _POPCNT8 = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+    return _POPCNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=np.int32)
+
+def phash_pairwise_dist(hashes) -> "np.ndarray":
+    """Ma trận khoảng cách Hamming giữa mọi cặp pHash (vd. các ảnh trong 1 album)."""
+    a = np.asarray(hashes, dtype=np.uint64)
+    return popcount64(a[:, None] ^ a[None, :])
+
+# ---- pHash INDEX: lưu bền toàn bộ lịch sử mọi kho, tìm ảnh gần giống dưới tuyến tính ----
+# File PHASH_DB_PATH: chuỗi bản ghi cố định 20 byte (phash u64, ngày dạng ordinal u32, id_kho u64),
+# chỉ ghi nối thêm → restart/redeploy vẫn phát hiện được ảnh cũ dùng lại.
+# Bộ nhớ: các mảng numpy liền mạch (hash/day/kho), nạp thẳng từ file bằng np.fromfile.
+# Tìm kiếm: multi-index hashing — chia hash 64 bit thành 4 khúc 16 bit; mỗi khúc có mảng khoá đã sắp xếp.
+# Hai hash cách nhau ≤ k bit thì có ít nhất 1 khúc cách nhau ≤ k // 4 bit (nguyên lý Dirichlet),
+# nên chỉ cần dò các giá trị lân cận của từng khúc (searchsorted) rồi kiểm lại cả 64 bit bằng XOR + popcount.
+# Bản ghi mới nằm ở "đuôi" chưa sắp xếp, được quét vector hoá; đuôi dài quá thì sắp xếp lại.
+from itertools import combinations
+
+PHASH_DB_PATH = os.getenv("PHASH_DB_PATH", "phashes.bin")
+PHASH_DUP_SIM = 0.90                                    # tương đồng ≥ 90% coi là trùng
+PHASH_MAX_DIST = int(64 * (1.0 - PHASH_DUP_SIM) + 1e-9)  # = 6 bit
+_PH_FIELDS = [("hash", "<u8"), ("day", "<u4"), ("kho", "<u8")]  # khớp định dạng file (20 byte)
+_PH_CHUNKS = 4
+_PH_CHUNK_BITS = 16
+_PH_TAIL_MIN = 4096
+
+_PH_INDEX = None  # {"n", "hash", "day", "kho", "n_sorted", "tables": [(khoá đã sắp, vị trí) × 4]}
+_PH_FLIPS = {}    # bán kính r -> mảng mask 16 bit có ≤ r bit 1
 
 def _dup_key(chat_id: int, id_kho: str) -> str:
     return f"{chat_id}|{id_kho}"
 
+def _ph_flips(r: int) -> "np.ndarray":
+    masks = _PH_FLIPS.get(r)
+    if masks is None:
+        out = [0]
+        for k in range(1, r + 1):
+            for bits in combinations(range(_PH_CHUNK_BITS), k):
+                out.append(sum(1 << b for b in bits))
+        masks = _PH_FLIPS[r] = np.array(out, dtype=np.uint16)
+    return masks
+
+def _ph_chunk(h, c: int):
+    return ((h >> np.uint64(_PH_CHUNK_BITS * c)) & np.uint64((1 << _PH_CHUNK_BITS) - 1)).astype(np.uint16)
+
+def _ph_rebuild(idx: dict):
+    n = idx["n"]
+    h = idx["hash"][:n]
+    tables = []
+    for c in range(_PH_CHUNKS):
+        keys = _ph_chunk(h, c)
+        order = np.argsort(keys, kind="stable")
+        tables.append((keys[order], order))
+    idx["tables"] = tables
+    idx["n_sorted"] = n
+
+def _phash_index() -> dict:
+    """Nạp pHash INDEX từ file (1 lần)."""
+    global _PH_INDEX
+    if _PH_INDEX is None:
+        try:
+            raw = np.fromfile(PHASH_DB_PATH, dtype=np.uint8)
+        except FileNotFoundError:
+            raw = np.zeros(0, dtype=np.uint8)
+        dt = np.dtype(_PH_FIELDS)
+        usable = len(raw) - len(raw) % dt.itemsize  # bỏ bản ghi dở dang nếu lần trước chết giữa chừng
+        rec = raw[:usable].view(dt)
+        n = len(rec)
+        cap = max(1024, 2 * n)
+        idx = {"n": n,
+               "hash": np.zeros(cap, np.uint64), "day": np.zeros(cap, np.uint32), "kho": np.zeros(cap, np.uint64)}
+        for col in ("hash", "day", "kho"):
+            idx[col][:n] = rec[col]
+        _ph_rebuild(idx)
+        _PH_INDEX = idx
+    return _PH_INDEX
+
+def phash_index_search(phash: int, max_dist: int = PHASH_MAX_DIST):
+    """
+    Tìm mọi ảnh cũ (mọi kho, mọi ngày) cách phash ≤ max_dist bit.
+    Trả về (khoảng cách nhỏ nhất, ordinal ngày sớm nhất) hoặc (None, None) nếu không có.
+    """
+    idx = _phash_index()
+    n, n_sorted = idx["n"], idx["n_sorted"]
+    if n == 0:
+        return None, None
+    q = np.uint64(phash)
+    flips = _ph_flips(max_dist // _PH_CHUNKS)
+    parts = []
+    for c, (keys, order) in enumerate(idx["tables"]):
+        probes = _ph_chunk(q, c) ^ flips
+        lo = np.searchsorted(keys, probes, side="left")
+        hi = np.searchsorted(keys, probes, side="right")
+        for a, b in zip(lo[hi > lo], hi[hi > lo]):
+            parts.append(order[a:b])
+    if n > n_sorted:
+        parts.append(np.arange(n_sorted, n))
+    if not parts:
+        return None, None
+    cand = np.unique(np.concatenate(parts))
+    dist = popcount64(idx["hash"][cand] ^ q)
+    ok = dist <= max_dist
+    if not ok.any():
+        return None, None
+    return int(dist[ok].min()), int(idx["day"][cand[ok]].min())
+
+def phash_index_add(phash: int, d: date, id_kho: str):
+    """Thêm 1 pHash vào index + ghi nối vào file."""
+    phash_index_add_many([phash], d, id_kho)
+
+def phash_index_add_many(phashes: list, d: date, id_kho: str):
+    """Thêm nhiều pHash (cùng kho/ngày, vd. 1 album) vào index + 1 lần ghi nối vào file."""
+    if not phashes:
+        return
+    try:
+        kho = int(id_kho)
+    except (TypeError, ValueError):
+        kho = 0
+    idx = _phash_index()
+    n, m = idx["n"], len(phashes)
+    if n + m > len(idx["hash"]):
+        cap = max(2 * len(idx["hash"]), n + m)
+        for col in ("hash", "day", "kho"):
+            grown = np.zeros(cap, idx[col].dtype)
+            grown[:n] = idx[col][:n]
+            idx[col] = grown
+    rec = np.zeros(m, dtype=np.dtype(_PH_FIELDS))
+    rec["hash"] = np.asarray(phashes, dtype=np.uint64)
+    rec["day"], rec["kho"] = d.toordinal(), kho
+    for col in ("hash", "day", "kho"):
+        idx[col][n:n + m] = rec[col]
+    idx["n"] = n + m
+    if idx["n"] - idx["n_sorted"] > max(_PH_TAIL_MIN, idx["n_sorted"] // 8):
+        _ph_rebuild(idx)
+    with open(PHASH_DB_PATH, "ab") as f:
+        f.write(rec.tobytes())
+
 def _dup_best_match(dup_key: str, phash: int):
-    dq = DUP_HISTORY.get(dup_key, deque())
-    best_sim, best_date = 0.0, None
-    for h, dstr in dq:
-        ham = _hamming64(h, phash)
-        sim = 1.0 - (ham / 64.0)
-        if sim > best_sim:
-            best_sim, best_date = sim, dstr
-    return best_sim, best_date
+    """(độ tương đồng tốt nhất, 'dd/mm/yyyy' ngày sớm nhất) trên toàn bộ lịch sử; (0.0, None) nếu không trùng."""
+    dist, first = phash_index_search(phash)
+    if dist is None:
+        return 0.0, None
+    return 1.0 - (dist / 64.0), date.fromordinal(first).strftime("%d/%m/%Y")
 
 def _dup_push(dup_key: str, phash: int, ngay_str: str):
-    dq = DUP_HISTORY.setdefault(dup_key, deque(maxlen=_DUP_MAX))
-    dq.append((phash, ngay_str))
-SCORING_BUFFER = defaultdict(list)  # key -> list[dict]
-SCORING_JOBS = {}
+    id_kho = dup_key.rsplit("|", 1)[-1]
+    phash_index_add(phash, datetime.strptime(ngay_str, "%d/%m/%Y").date(), id_kho)
+SCORING_BUFFER = TTLCache("scoring_buffer", ttl=600, default_factory=list)  # key -> list[dict]
+SCORING_JOBS = TTLCache("scoring_jobs", ttl=600)
 
 
 def _schedule_scoring_job(context, chat_id:int, id_kho:str, ngay_str:str, text_md:str):
@@ -419,47 +1162,72 @@ def _diagnose_varied(kv_key: str, parts: dict) -> tuple[list, list]:
 
     return _dedup(issues, 5), _dedup(recs, 5)
 # ========== END DIAGNOSTICS VARIETY ==========
-def apply_scoring_struct(photo_bytes: bytes, kv_active: str|None, is_duplicate: bool, dup_key: str, ngay_str: str):
+def apply_scoring_struct(photo_bytes, kv_active: str|None, is_duplicate: bool, dup_key: str, ngay_str: str):
     """
     Trả về cấu trúc cho gộp: {'total','grade','issues','recs','dup','sim','dup_date'}
     Bắt buộc có vấn đề/khuyến nghị nếu total < 95.
-    Tính tương đồng ảnh bằng pHash và lưu lịch sử theo (chat_id|id_kho).
+    Tính tương đồng ảnh bằng pHash trên toàn bộ lịch sử mọi kho (pHash INDEX, lưu bền qua restart).
+    photo_bytes: bytes ảnh hoặc ImageCtx (ảnh chỉ decode 1 lần cho mọi bước).
     """
     if not SCORING_ENABLED:
         return {'total': 0, 'grade': 'C', 'issues': [], 'recs': [], 'dup': is_duplicate, 'sim': 0.0, 'dup_date': None}
+    feats = extract_scoring_features(photo_bytes, kv_active or "")
+    return finish_scoring_struct(feats, is_duplicate, dup_key, ngay_str)
 
+def extract_scoring_features(photo_bytes, kv_text: str) -> dict:
+    """
+    Phần tính toán nặng (OpenCV) của chấm điểm, không đụng trạng thái của bot
+    → chạy được trong process worker. Kết quả là dict thuần (pickle được).
+    """
     # 1) Đọc ảnh + pHash
-    img = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+    ctx = _as_ctx(photo_bytes)
     try:
-        phash = _phash_cv(img)
+        phash = ctx.memo("phash", _phash_cv)
     except Exception:
         phash = None
+    # 2) Chất lượng  3) Nội dung theo KV
+    quality = ctx.memo("quality", _score_quality_components)
+    parts, kv_key = _score_by_kv(ctx, kv_text)
+    return {
+        "phash": phash,
+        "quality": quality,
+        "parts": parts,
+        "kv_key": kv_key,
+    }
 
-    # 2) Chất lượng
-    sharp_s, bright_s, size_s, (w, h) = _score_quality_components(img)
+def score_total(feats: dict, is_duplicate: bool = False) -> tuple:
+    """(tổng điểm 0..100, hạng A/B/C) từ features: 20% chất lượng ảnh + 80% nội dung theo KV, trừ 10 điểm nếu trùng."""
+    sharp_s, bright_s = feats["quality"][0], feats["quality"][1]
     q_score = 0.2 * (0.6 * sharp_s + 0.4 * bright_s)
-
-    # 3) Nội dung theo KV
-    parts, kv_key = _score_by_kv(photo_bytes, kv_active or "")
+    kv_key = feats["kv_key"]
     weights = AREA_RULE_WEIGHTS.get(kv_key, _DEFAULT_WEIGHTS[kv_key])
     total_w = float(sum(weights.values())) or 100.0
     content_s = 0.0
-    for name, val in parts.items():
+    for name, val in feats["parts"].items():
         w_part = float(weights.get(name, 0.0))
         content_s += (float(val) * (w_part / total_w) * 0.8)
+    dup_penalty = 0.10 if is_duplicate else 0.0
+    total = int(round(max(0.0, q_score + content_s - dup_penalty) * 100))
+    return total, ("A" if total >= 80 else ("B" if total >= 65 else "C"))
+
+def finish_scoring_struct(feats: dict, is_duplicate: bool, dup_key: str, ngay_str: str, dup_match=None) -> dict:
+    """
+    Phần còn lại của apply_scoring_struct (chạy ở process chính): so trùng pHash, tổng điểm, vấn đề/khuyến nghị.
+    dup_match: (sim, 'dd/mm/yyyy') đã tra sẵn (finish_scoring_batch) → bỏ qua tra index và lưu pHash ở đây.
+    """
+    phash = feats["phash"]
+    sharp_s, bright_s, size_s, (w, h) = feats["quality"]
+    parts, kv_key = feats["parts"], feats["kv_key"]
 
     # 4) So trùng (pHash) trên lịch sử nhiều ngày
     sim_best, sim_date = 0.0, None
     if phash is not None and dup_key:
-        sim_best, sim_date = _dup_best_match(dup_key, phash)
+        sim_best, sim_date = dup_match if dup_match is not None else _dup_best_match(dup_key, phash)
         if sim_best >= 0.90:
             is_duplicate = True
 
     # 5) Tổng điểm
-    dup_penalty = 0.10 if is_duplicate else 0.0
-    total_norm = max(0.0, q_score + content_s - dup_penalty)
-    total = int(round(total_norm * 100))
-    grade = "A" if total >= 80 else ("B" if total >= 65 else "C")
+    total, grade = score_total(feats, is_duplicate)
 
     # 6) Vấn đề / Khuyến nghị
     issues, recs = _diagnose_varied(kv_key, parts)
@@ -487,13 +1255,120 @@ def apply_scoring_struct(photo_bytes: bytes, kv_active: str|None, is_duplicate:
 
     # 7) Lưu lịch sử pHash
     try:
-        if phash is not None and dup_key:
+        if phash is not None and dup_key and dup_match is None:
             _dup_push(dup_key, phash, ngay_str)
     except Exception:
         pass
 
     return {'total': total, 'grade': grade, 'issues': issues, 'recs': recs, 'dup': is_duplicate, 'sim': sim_best, 'dup_date': sim_date}
 
+def finish_scoring_batch(feats_list: list, dup_key: str, ngay_str: str) -> list:
+    """
+    finish_scoring_struct cho cả lô ảnh cùng kho/ngày (album): tra lịch sử từng ảnh,
+    so chéo trong lô bằng 1 ma trận pHash, lưu pHash cả lô 1 lần. Kết quả như chấm lần lượt từng ảnh.
+    """
+    d = datetime.strptime(ngay_str, "%d/%m/%Y").date()
+    valid = [i for i, f in enumerate(feats_list) if f.get("phash") is not None]
+    pair = phash_pairwise_dist([feats_list[i]["phash"] for i in valid]) if valid else None
+    matches = [None] * len(feats_list)
+    for k, i in enumerate(valid):
+        dist, first = phash_index_search(feats_list[i]["phash"])
+        earlier = pair[k, :k]
+        earlier = earlier[earlier <= PHASH_MAX_DIST]
+        if len(earlier):  # gần giống ảnh đứng trước trong cùng lô (ngày = ngày của lô)
+            dist = int(earlier.min()) if dist is None else min(dist, int(earlier.min()))
+            first = d.toordinal() if first is None else min(first, d.toordinal())
+        matches[i] = (0.0, None) if dist is None else (1.0 - dist / 64.0, date.fromordinal(first).strftime("%d/%m/%Y"))
+    items = [finish_scoring_struct(f, False, dup_key, ngay_str, dup_match=matches[i]) for i, f in enumerate(feats_list)]
+    try:
+        if valid and dup_key:
+            phash_index_add_many([feats_list[i]["phash"] for i in valid], d, dup_key.rsplit("|", 1)[-1])
+    except Exception:
+        pass
+    return items
+
+
+# ========= FEATURE STORE (đặc trưng chấm điểm theo MD5) =========
+# Mỗi ảnh đã chấm được ghi nối 1 bản ghi cố định vào FEATURE_STORE_PATH: md5, ngày, kho, KV, điểm thành phần
+# theo KV (đúng thứ tự trong _DEFAULT_WEIGHTS), chất lượng ảnh, kích thước, pHash, cờ trùng và tổng điểm đã gửi.
+# Nạp bằng np.fromfile thành các cột numpy → đổi AREA_RULE_WEIGHTS / AREA_RULE_THRESHOLDS thì tính lại điểm
+# cả lịch sử bằng phép toán vector (rescore_features), không cần ảnh gốc. Công thức giống hệt score_total.
+FEATURE_STORE_PATH = os.getenv("FEATURE_STORE_PATH", "features.bin")  # rỗng = tắt
+_FS_KVS = list(_DEFAULT_WEIGHTS)                                       # KV -> chỉ số (cột "kv")
+_FS_METRICS = {kv: list(w) for kv, w in _DEFAULT_WEIGHTS.items()}      # KV -> tên các cột part0..2
+_FS_NPARTS = max(len(m) for m in _FS_METRICS.values())
+_FS_FIELDS = [("md5", "u1", (16,)), ("day", "<u4"), ("kho", "<u8"), ("kv", "u1"), ("flags", "u1"), ("total", "u1"),
+              ("phash", "<u8"), ("width", "<u2"), ("height", "<u2"),
+              ("sharp", "<f8"), ("bright", "<f8"), ("size", "<f4"), ("parts", "<f8", (_FS_NPARTS,))]  # 87 byte
+_FS_DUP, _FS_HAS_PHASH = 1, 2  # bit trong "flags"
+
+def feature_store_append(rows: list, d: date, id_kho: str):
+    """rows: [(md5 hex, features, item của finish_scoring_*)] cùng kho/ngày → 1 lần ghi nối."""
+    if not FEATURE_STORE_PATH or not rows:
+        return
+    try:
+        kho = int(id_kho)
+    except (TypeError, ValueError):
+        kho = 0
+    rec = np.zeros(len(rows), dtype=np.dtype(_FS_FIELDS))
+    for i, (h, feats, item) in enumerate(rows):
+        sharp_s, bright_s, size_s, (w, hgt) = feats["quality"]
+        r = rec[i]
+        r["md5"] = np.frombuffer(bytes.fromhex(h), np.uint8)
+        r["day"], r["kho"], r["kv"] = d.toordinal(), kho, _FS_KVS.index(feats["kv_key"])
+        r["flags"] = (_FS_DUP if item.get("dup") else 0) | (_FS_HAS_PHASH if feats.get("phash") is not None else 0)
+        r["total"], r["phash"] = item["total"], feats.get("phash") or 0
+        r["width"], r["height"] = min(int(w), 0xFFFF), min(int(hgt), 0xFFFF)
+        r["sharp"], r["bright"], r["size"] = sharp_s, bright_s, size_s
+        r["parts"] = [feats["parts"].get(name, 0.0) for name in _FS_METRICS[feats["kv_key"]]]
+    with open(FEATURE_STORE_PATH, "ab") as f:
+        f.write(rec.tobytes())
+
+def feature_store_load(path: str = None, latest: bool = True) -> "np.ndarray":
+    """Mảng bản ghi (structured, truy cập theo cột). latest: mỗi md5 chỉ giữ bản ghi mới nhất."""
+    try:
+        raw = np.fromfile(path or FEATURE_STORE_PATH, dtype=np.uint8)
+    except FileNotFoundError:
+        raw = np.zeros(0, dtype=np.uint8)
+    dt = np.dtype(_FS_FIELDS)
+    rec = raw[:len(raw) - len(raw) % dt.itemsize].view(dt)  # bỏ bản ghi dở dang nếu lần trước chết giữa chừng
+    if latest and len(rec):
+        # md5 → 2 số u64, sắp xếp ổn định trên thứ tự đảo ngược: bản ghi đầu mỗi nhóm là bản mới nhất
+        key = np.ascontiguousarray(rec["md5"][::-1]).view("<u8")
+        order = np.lexsort((key[:, 1], key[:, 0]))
+        ks = key[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (ks[1:] != ks[:-1]).any(axis=1)
+        rec = rec[np.sort(len(rec) - 1 - order[first])]
+    return rec
+
+def rescore_features(rec, weights: dict = None, thresholds: dict = None) -> dict:
+    """
+    Tính lại điểm cả lịch sử theo bộ trọng số/ngưỡng (mặc định: cấu hình hiện tại), không decode ảnh.
+    Trả về {"total": int[n], "grade": str[n], "below": bool[n, part]} — below: hạng mục dưới ngưỡng (→ vấn đề/khuyến nghị).
+    """
+    weights = AREA_RULE_WEIGHTS if weights is None else weights
+    thresholds = AREA_RULE_THRESHOLDS if thresholds is None else thresholds
+    W = np.zeros((len(_FS_KVS), _FS_NPARTS))
+    T = np.full((len(_FS_KVS), _FS_NPARTS), np.inf)
+    for k, kv in enumerate(_FS_KVS):
+        w = weights.get(kv, _DEFAULT_WEIGHTS[kv])
+        total_w = float(sum(w.values())) or 100.0
+        th = thresholds.get(kv, _AREA_RULE_THRESHOLDS[kv])
+        for j, name in enumerate(_FS_METRICS[kv]):
+            W[k, j] = float(w.get(name, 0.0)) / total_w
+            T[k, j] = float(th.get(name, 0.75))
+    kv = rec["kv"].astype(np.intp)
+    parts = rec["parts"]
+    # cùng thứ tự phép tính với score_total → cùng cấu hình thì ra đúng tổng điểm đã gửi
+    q_score = 0.2 * (0.6 * rec["sharp"] + 0.4 * rec["bright"])
+    content = np.zeros(len(rec))
+    for j in range(_FS_NPARTS):
+        content += parts[:, j] * W[kv, j] * 0.8
+    dup_penalty = np.where(rec["flags"] & _FS_DUP, 0.10, 0.0)
+    total = np.rint(np.maximum(0.0, q_score + content - dup_penalty) * 100).astype(np.int64)
+    grade = np.where(total >= 80, "A", np.where(total >= 65, "B", "C"))
+    return {"total": total, "grade": grade, "below": parts < T[kv]}
 
 def _compose_aggregate_message(items: list, id_kho: str, ngay_str: str) -> str:
     header = f"📋 Điểm 5S cho lô ảnh này\n- Kho: {get_kho_display(id_kho)} · Ngày: {ngay_str}\n"
@@ -531,7 +1406,7 @@ async def _send_scoring_aggregate(context: ContextTypes.DEFAULT_TYPE):
     if not items: return
     text = _compose_aggregate_message(items, id_kho, ngay_str)
     try:
-        await safe_send_message(context.bot, chat_id=chat_id, text=text)
+        await safe_send_message(context.bot, chat_id=chat_id, text=text, priority=PRIO_SCORING)
     except Exception:
         pass
 
@@ -557,8 +1432,7 @@ async def _warning_job(context):
 
     # Đọc lại count mới nhất để cảnh báo chính xác
     try:
-        count_db = load_count_db()
-        cur = int(count_db.get(day, {}).get(str(id_kho), 0))
+        cur = db_get_count(str(id_kho), date.fromisoformat(day))
     except Exception:
         cur = 0
 
@@ -590,16 +1464,17 @@ def schedule_delayed_warning(context, chat_id, id_kho, d):
 # ========= JSON UTILS =========
 def _load_json(path: str, default):
     try:
-        with open(path, "r", encoding="utf-8") as f:
+        with span("json_load", file=os.path.basename(path)), open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return default
 
 def _save_json(path: str, data):
     tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
+    with span("json_save", file=os.path.basename(path)):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
 
 def load_hash_db():
     return _load_json(HASH_DB_PATH, {"items": []})
@@ -625,17 +1500,743 @@ def load_past_db():
 def save_past_db(db):
     _save_json(PAST_DB_PATH, db)
 
+# ========= STORAGE BACKEND (json | sqlite) =========
+# json   : giữ nguyên 4 file JSON như cũ, ghi trễ qua WRITE-BEHIND (xem bên dưới).
+# sqlite : 1 file SQLite (WAL) có index; mỗi ảnh hợp lệ = 1 transaction nhỏ.
+#          Lần mở đầu tiên tự chuyển dữ liệu từ 4 file JSON sang (chỉ chạy 1 lần).
+import atexit
+import sqlite3
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower() or "json"
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "bot5s.db")
+
+_SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    id      INTEGER PRIMARY KEY,
+    hash    TEXT NOT NULL,
+    id_kho  TEXT NOT NULL,
+    day     TEXT NOT NULL,
+    ts      TEXT,
+    chat_id INTEGER,
+    user_id INTEGER,
+    file_unique_id TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_hashes_hash ON hashes(hash, day);
+CREATE INDEX IF NOT EXISTS ix_hashes_day ON hashes(day);
+CREATE TABLE IF NOT EXISTS submissions (
+    day    TEXT NOT NULL,
+    id_kho TEXT NOT NULL,
+    PRIMARY KEY (day, id_kho)
+);
+CREATE TABLE IF NOT EXISTS counts (
+    day    TEXT NOT NULL,
+    id_kho TEXT NOT NULL,
+    count  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, id_kho)
+);
+CREATE TABLE IF NOT EXISTS past_uses (
+    id        INTEGER PRIMARY KEY,
+    day       TEXT NOT NULL,
+    id_kho    TEXT NOT NULL,
+    prev_date TEXT,
+    hash      TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_past_uses_day ON past_uses(day);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_SQL_CONN = None
+_SQL_LOCK = threading.RLock()
+
+def _sql_conn() -> sqlite3.Connection:
+    """Mở (1 lần) kết nối SQLite dùng chung, bật WAL và chuyển dữ liệu JSON cũ nếu chưa làm."""
+    global _SQL_CONN
+    with _SQL_LOCK:
+        if _SQL_CONN is None:
+            conn = sqlite3.connect(SQLITE_DB_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SQL_SCHEMA)
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(hashes)")}
+            if "file_unique_id" not in cols:  # DB tạo trước khi có cột này
+                conn.execute("ALTER TABLE hashes ADD COLUMN file_unique_id TEXT")
+            migrate_json_to_sqlite(conn)
+            _SQL_CONN = conn
+        return _SQL_CONN
+
+def migrate_json_to_sqlite(conn: sqlite3.Connection) -> bool:
+    """
+    Chuyển hashes.json / submissions.json / counts.json / past_uses.json sang SQLite.
+    Chạy đúng 1 lần (đánh dấu trong bảng meta); các file JSON được giữ nguyên để đối chiếu.
+    """
+    with _SQL_LOCK:
+        done = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done:
+            return False
+        dbs, _ = _wb_read_all()  # file JSON + journal chưa kịp flush
+        hash_db, submit_db, count_db, past_db = dbs["hash"], dbs["submit"], dbs["count"], dbs["past"]
+        with conn:
+            conn.executemany(
+                "INSERT INTO hashes(hash, id_kho, day, ts, chat_id, user_id, file_unique_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(it.get("hash"), str(it.get("id_kho")), it.get("date"), it.get("ts"), it.get("chat_id"), it.get("user_id"),
+                  it.get("file_unique_id"))
+                 for it in hash_db.get("items", []) if it.get("hash") and it.get("date")]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO submissions(day, id_kho) VALUES (?, ?)",
+                [(day, str(kid)) for day, ids in submit_db.items() for kid in ids]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO counts(day, id_kho, count) VALUES (?, ?, ?)",
+                [(day, str(kid), int(c)) for day, per_kho in count_db.items() for kid, c in per_kho.items()]
+            )
+            conn.executemany(
+                "INSERT INTO past_uses(day, id_kho, prev_date, hash) VALUES (?, ?, ?, ?)",
+                [(day, str(it.get("id_kho")), it.get("prev_date"), it.get("hash"))
+                 for day, arr in past_db.items() for it in arr]
+            )
+            conn.execute(
+                "INSERT INTO meta(key, value) VALUES ('json_migrated', ?)",
+                (datetime.now(TZ).isoformat(timespec="seconds"),)
+            )
+        logging.info(
+            "Đã chuyển JSON → SQLite: %d hash, %d ngày nộp, %d ngày đếm, %d ngày ảnh quá khứ",
+            len(hash_db.get("items", [])), len(submit_db), len(count_db), len(past_db)
+        )
+        return True
+
+# ========= WRITE-BEHIND (backend json) =========
+# 4 DB JSON nằm trong RAM. Mỗi thay đổi: ghi 1 dòng vào journal (append) rồi đánh dấu DB "bẩn".
+# fsync journal chạy ở thread (await storage_sync() trước khi báo đã ghi nhận) → event loop không chờ đĩa;
+# nhiều lô ghi cùng lúc dùng chung 1 lần fsync.
+# Thread nền ghi lại các file bẩn sau FLUSH_INTERVAL giây hoặc khi đủ FLUSH_EVERY thay đổi.
+# Khởi động: nạp file JSON + phát lại journal → crash giữa 2 lần flush không mất ảnh nào.
+# Mỗi thao tác trong journal phát lại nhiều lần vẫn cho cùng kết quả (số đếm tuyệt đối, bỏ bản ghi đã có).
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "store.journal")
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
+FLUSH_EVERY = int(os.getenv("FLUSH_EVERY", "50"))
+
+_WB = None  # {"dbs": {"hash","submit","count","past"}, "dirty": set, "pending": int, "journal": file,
+            #  "rotated": journal vừa xoay sang .old còn chờ fsync (hoặc None),
+            #  "written"/"synced": số thao tác đã ghi vào journal / đã fsync}
+_WB_LOCK = threading.RLock()
+_WB_FLUSH_LOCK = threading.Lock()
+_WB_EVENT = threading.Event()
+
+def _wb_paths() -> dict:
+    return {"hash": HASH_DB_PATH, "submit": SUBMIT_DB_PATH, "count": COUNT_DB_PATH, "past": PAST_DB_PATH}
+
+def _wb_item_key(item: dict) -> tuple:
+    return (item.get("hash"), item.get("id_kho"), item.get("date"), item.get("ts"))
+
+def _wb_apply(dbs: dict, rec: dict, seen: set = None) -> set:
+    """
+    Áp 1 thao tác journal vào các DB trong RAM. Trả về tên các DB bị đổi.
+    seen: khi phát lại journal — tập khoá các ảnh đã có trong hashes.json để không thêm trùng.
+    """
+    op = rec.get("op")
+    if op == "photo":
+        info = rec["info"]
+        id_kho, day = info["id_kho"], info["date"]
+        mark_submitted(dbs["submit"], id_kho, date.fromisoformat(day))
+        item = {"hash": rec["h"], **info}
+        if seen is None:
+            dbs["hash"]["items"].append(item)
+        elif _wb_item_key(item) not in seen:
+            seen.add(_wb_item_key(item))
+            dbs["hash"]["items"].append(item)
+        per_day = dbs["count"].setdefault(day, {})
+        per_day[id_kho] = max(int(per_day.get(id_kho, 0)), int(rec["count"]))
+        return {"submit", "hash", "count"}
+    if op == "past":
+        arr = dbs["past"].setdefault(rec["day"], [])
+        entry = rec["entry"]
+        if seen is None or entry not in arr:
+            arr.append(entry)
+        return {"past"}
+    return set()
+
+def _wb_read_journal(path: str) -> list:
+    out = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    break  # dòng cuối ghi dở khi crash
+    except FileNotFoundError:
+        pass
+    return out
+
+def _wb_read_all():
+    """
+    Nạp 4 file JSON rồi phát lại journal (bản đang flush dở .old trước, bản hiện tại sau).
+    Trả về (dbs, số thao tác đã phát lại).
+    """
+    dbs = {"hash": load_hash_db(), "submit": load_submit_db(), "count": load_count_db(), "past": load_past_db()}
+    recs = _wb_read_journal(JOURNAL_PATH + ".old") + _wb_read_journal(JOURNAL_PATH)
+    if recs:
+        seen = {_wb_item_key(it) for it in dbs["hash"].get("items", [])}
+        for rec in recs:
+            _wb_apply(dbs, rec, seen)
+    return dbs, len(recs)
+
+def _wb() -> dict:
+    global _WB
+    with _WB_LOCK:
+        if _WB is None:
+            dbs, replayed = _wb_read_all()
+            _WB = {"dbs": dbs, "dirty": set(_wb_paths()) if replayed else set(), "pending": 0,
+                   "journal": open(JOURNAL_PATH, "a", encoding="utf-8"), "rotated": None, "written": 0, "synced": 0}
+            threading.Thread(target=_wb_flush_loop, name="json-write-behind", daemon=True).start()
+            if replayed:
+                _WB_EVENT.set()
+        return _WB
+
+def _wb_mutate(rec: dict):
+    """Ghi journal rồi áp thay đổi vào RAM (lưu bền sau journal_sync/storage_sync)."""
+    _wb_mutate_many([rec])
+
+def _wb_mutate_many(recs: list):
+    """Như _wb_mutate cho nhiều thao tác: ghi cả lô vào journal 1 lần (chưa fsync)."""
+    with _WB_LOCK:
+        wb = _wb()
+        j = wb["journal"]
+        with span("journal_write"):
+            j.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in recs))
+            j.flush()  # đã vào OS: bot chết đột ngột vẫn còn, chỉ mất điện/treo máy mới cần fsync
+        for rec in recs:
+            wb["dirty"] |= _wb_apply(wb["dbs"], rec)
+        wb["pending"] += len(recs)
+        wb["written"] += len(recs)
+        if wb["pending"] >= FLUSH_EVERY:
+            _WB_EVENT.set()
+
+def journal_sync():
+    """fsync journal (chạy ở thread): mọi thao tác đã ghi trước lời gọi này được lưu bền."""
+    with _WB_LOCK:
+        wb = _WB
+        if wb is None or wb["synced"] >= wb["written"]:
+            return
+        target = wb["written"]
+        # fsync ngoài lock, không chặn lô ghi tiếp theo; gồm cả journal vừa xoay mà flush chưa fsync xong
+        fds = [os.dup(j.fileno()) for j in (wb["rotated"], wb["journal"]) if j is not None]
+    try:
+        with span("journal_fsync"):
+            for fd in fds:
+                os.fsync(fd)
+    finally:
+        for fd in fds:
+            os.close(fd)
+    with _WB_LOCK:
+        wb["synced"] = max(wb["synced"], target)
+
+async def storage_sync():
+    """Chờ journal lưu bền mà không chặn event loop (backend sqlite: không cần)."""
+    wb = _WB
+    if wb is not None and wb["synced"] < wb["written"]:
+        await asyncio.to_thread(journal_sync)
+
+def _wb_write_file(path: str, text: str):
+    tmp = path + ".tmp"
+    with span("json_write", file=os.path.basename(path)):
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+def _wb_snapshot(db: dict) -> dict:
+    """
+    Bản chụp rẻ của 1 DB để serialize ngoài lock: _wb_apply/compact chỉ sửa tại chỗ tới tầng 2
+    (list items, list/dict theo ngày); bản ghi hash thì không bao giờ bị sửa.
+    """
+    return {k: (v.copy() if isinstance(v, (dict, list)) else v) for k, v in db.items()}
+
+def flush_storage():
+    """Ghi các DB bẩn xuống file JSON (chạy ở thread nền; gọi trực tiếp khi tắt bot)."""
+    if _WB is None:
+        return
+    with _WB_FLUSH_LOCK:
+        # Trong lock chỉ: chụp DB bẩn (copy nông), xoá cờ bẩn và xoay journal sang .old
+        with _WB_LOCK:
+            wb = _WB
+            if not wb["dirty"]:
+                return
+            names = set(wb["dirty"])
+            snap = {n: _wb_snapshot(wb["dbs"][n]) for n in names}
+            wb["dirty"].clear()
+            wb["pending"] = 0
+            old_journal, target = wb["journal"], wb["written"]
+            old = JOURNAL_PATH + ".old"
+            if os.path.exists(old):  # lần flush trước lỗi → gộp tiếp vào .old (hiếm)
+                with open(old, "a", encoding="utf-8") as dst, open(JOURNAL_PATH, "r", encoding="utf-8") as src:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(JOURNAL_PATH)
+            elif os.path.exists(JOURNAL_PATH):
+                os.replace(JOURNAL_PATH, old)  # handle cũ vẫn trỏ tới file (giờ là .old)
+            wb["journal"] = open(JOURNAL_PATH, "a", encoding="utf-8")
+            wb["rotated"] = old_journal
+        # Ngoài lock: fsync journal cũ, serialize và ghi file — lô ghi mới không phải chờ
+        try:
+            if wb["synced"] < target:
+                with span("journal_fsync"):
+                    os.fsync(old_journal.fileno())
+                with _WB_LOCK:
+                    wb["synced"] = max(wb["synced"], target)
+        finally:
+            with _WB_LOCK:
+                wb["rotated"] = None
+            old_journal.close()
+        try:
+            paths = _wb_paths()
+            for n, db in snap.items():
+                _wb_write_file(paths[n], json.dumps(db, ensure_ascii=False, separators=(",", ":")))
+        except Exception:
+            logging.exception("Ghi file JSON lỗi → giữ journal, thử lại lần sau")
+            with _WB_LOCK:
+                wb["dirty"] |= names
+            return
+        try:
+            os.remove(JOURNAL_PATH + ".old")
+        except FileNotFoundError:
+            pass
+
+atexit.register(flush_storage)
+
+def _wb_flush_loop():
+    while True:
+        _WB_EVENT.wait(FLUSH_INTERVAL)
+        _WB_EVENT.clear()
+        try:
+            flush_storage()
+        except Exception:
+            logging.exception("Lỗi thread ghi nền")
+
+def db_iter_hashes():
+    """Toàn bộ lịch sử hash: (hash, id_kho, 'YYYY-MM-DD', file_unique_id) — chỉ dùng khi nạp HASH INDEX lúc khởi động."""
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            rows = _sql_conn().execute("SELECT hash, id_kho, day, file_unique_id FROM hashes").fetchall()
+        return rows
+    with _WB_LOCK:
+        items = list(_wb()["dbs"]["hash"]["items"])
+    return [(it.get("hash"), it.get("id_kho"), it.get("date"), it.get("file_unique_id"))
+            for it in items if it.get("hash")]
+
+def db_record_photo(h: str, info: dict) -> int:
+    """Ghi nhận 1 ảnh hợp lệ (nộp + hash + đếm). Trả về số ảnh hiện tại của kho trong ngày."""
+    return db_record_photos([(h, info)])[0]
+
+def db_record_photos(items: list) -> list:
+    """Ghi nhận nhiều ảnh [(hash, info), ...] trong 1 transaction/1 lần ghi journal. Trả về số đếm sau từng ảnh."""
+    if not items:
+        return []
+    counts = []
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK, span("sqlite_tx"):
+            conn = _sql_conn()
+            with conn:
+                for h, info in items:
+                    id_kho, day = info["id_kho"], info["date"]
+                    conn.execute("INSERT OR IGNORE INTO submissions(day, id_kho) VALUES (?, ?)", (day, id_kho))
+                    conn.execute(
+                        "INSERT INTO hashes(hash, id_kho, day, ts, chat_id, user_id, file_unique_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (h, id_kho, day, info.get("ts"), info.get("chat_id"), info.get("user_id"), info.get("file_unique_id"))
+                    )
+                    conn.execute(
+                        "INSERT INTO counts(day, id_kho, count) VALUES (?, ?, 1) "
+                        "ON CONFLICT(day, id_kho) DO UPDATE SET count = count + 1",
+                        (day, id_kho)
+                    )
+                    row = conn.execute("SELECT count FROM counts WHERE day = ? AND id_kho = ?", (day, id_kho)).fetchone()
+                    counts.append(int(row[0]))
+    else:
+        with _WB_LOCK:
+            dbs = _wb()["dbs"]
+            recs, cur = [], {}
+            for h, info in items:
+                k = (info["id_kho"], info["date"])
+                if k not in cur:
+                    cur[k] = get_count(dbs["count"], k[0], date.fromisoformat(k[1]))
+                cur[k] += 1
+                recs.append({"op": "photo", "h": h, "info": info, "count": cur[k]})
+                counts.append(cur[k])
+            _wb_mutate_many(recs)
+    for (h, info), c in zip(items, counts):
+        hash_index_add(h, info["id_kho"], info["date"], info.get("file_unique_id"))
+        day_agg_on_photo(info["id_kho"], info["date"], c)
+    return counts
+
+# ========= HASH INDEX (MD5 → các lần xuất hiện) =========
+# Nạp 1 lần lúc khởi động, cập nhật dần mỗi khi ghi nhận ảnh → tra trùng O(1), không quét lại lịch sử.
+# md5 -> {"seen": {(id_kho, day)}, "first": [tối đa 2 ngày nhỏ nhất, tăng dần]} ("seen" chỉ có với ngày còn trong file nóng)
+# Kèm FILE ID INDEX: file_unique_id (Telegram) -> (md5, id_kho, day) lần đầu ghi nhận,
+# để ảnh forward/gửi lại được nhận ra trùng mà không cần tải file.
+_HASH_INDEX = None
+_FILEID_INDEX = {}
+
+def _hash_index() -> dict:
+    global _HASH_INDEX
+    if _HASH_INDEX is None:
+        idx = {}
+        for h, day in hash_archive_iter():  # ngày đã chuyển sang archive: chỉ cần biết ngày đầu tiên
+            _hash_index_first(idx, h, day)
+        for h, id_kho, day, fuid in db_iter_hashes():
+            _hash_index_put(idx, h, str(id_kho), day)
+            if fuid:
+                _FILEID_INDEX.setdefault(fuid, (h, str(id_kho), day))
+        _HASH_INDEX = idx
+    return _HASH_INDEX
+
+def _hash_index_first(idx: dict, h: str, day: str) -> dict:
+    rec = idx.get(h)
+    if rec is None:
+        rec = idx[h] = {"first": []}
+    first = rec["first"]
+    if day and day not in first:
+        first.append(day)
+        first.sort()
+        del first[2:]
+    return rec
+
+def _hash_index_put(idx: dict, h: str, id_kho: str, day: str):
+    rec = _hash_index_first(idx, h, day)
+    rec.setdefault("seen", set()).add((id_kho, day))
+
+def hash_index_add(h: str, id_kho: str, day: str, fuid: str = None):
+    if _HASH_INDEX is not None:
+        _hash_index_put(_HASH_INDEX, h, str(id_kho), day)
+        if fuid:
+            _FILEID_INDEX.setdefault(fuid, (h, str(id_kho), day))
+
+def fileid_index_get(fuid: str):
+    """(md5, id_kho, day) của ảnh có file_unique_id này đã ghi nhận trước đó, hoặc None."""
+    _hash_index()
+    return _FILEID_INDEX.get(fuid) if fuid else None
+
+def hash_index_same_day(h: str, id_kho: str, day: str) -> bool:
+    """Kho này trong ngày `day` đã có ảnh giống hệt chưa."""
+    rec = _hash_index().get(h)
+    return bool(rec) and (str(id_kho), day) in rec.get("seen", ())
+
+def hash_index_earliest_prev(h: str, day: str):
+    """Ngày sớm nhất (khác `day`) mà ảnh này từng được gửi, hoặc None."""
+    rec = _hash_index().get(h)
+    if not rec:
+        return None
+    for d in rec["first"]:
+        if d != day:
+            return d
+    return None
+
+# ========= LƯU TRỮ DÀI HẠN (giữ RETENTION_DAYS ngày gần nhất trong file nóng) =========
+# Backend json: các ngày cũ hơn RETENTION_DAYS được chuyển khỏi 4 file JSON sang ARCHIVE_DIR/YYYY-MM.json.gz
+# (mỗi tháng 1 file nén, ghi gộp được nhiều lần). Để vẫn nhận ra "ảnh quá khứ", mỗi cặp (md5, ngày) đã
+# chuyển đi được ghi nối vào HASH_ARCHIVE_PATH (20 byte/bản ghi: md5 16 byte + ngày ordinal u32).
+# pHash đã nằm sẵn trong PHASH_DB_PATH (20 byte/ảnh) nên không cần chuyển.
+# Chỉ xoá khỏi file nóng sau khi archive đã ghi xong (fsync); chết giữa chừng thì lần sau chuyển lại, gộp không trùng.
+import gzip
+import struct
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))     # 0 = giữ toàn bộ trong file nóng như trước
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+HASH_ARCHIVE_PATH = os.getenv("HASH_ARCHIVE_PATH", "hash_archive.bin")
+COMPACT_HOUR = int(os.getenv("COMPACT_HOUR", "3"))          # giờ chạy dọn hằng ngày
+_HA_REC = struct.Struct("<16sI")  # md5 16 byte + ngày ordinal u32
+
+def hash_archive_iter():
+    """(md5, 'YYYY-MM-DD') của các ảnh đã chuyển sang archive."""
+    try:
+        with open(HASH_ARCHIVE_PATH, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return []
+    raw = raw[:len(raw) - len(raw) % _HA_REC.size]
+    days = {}
+    out = []
+    for md5, o in _HA_REC.iter_unpack(raw):
+        d = days.get(o)
+        if d is None:
+            d = days[o] = date.fromordinal(o).isoformat()
+        out.append((md5.hex(), d))
+    return out
+
+def _hash_archive_append(pairs):
+    """Ghi nối các cặp (md5, ngày); mỗi md5 chỉ giữ 2 ngày nhỏ nhất (đủ cho hash_index_earliest_prev)."""
+    best = {}
+    for h, day in pairs:
+        try:
+            key = bytes.fromhex(h)
+        except (TypeError, ValueError):
+            continue
+        if len(key) != 16:
+            continue
+        ds = best.setdefault(key, [])
+        if day not in ds:
+            ds.append(day)
+            ds.sort()
+            del ds[2:]
+    data = b"".join(_HA_REC.pack(k, date.fromisoformat(d).toordinal()) for k, ds in best.items() for d in ds)
+    if not data:
+        return
+    with open(HASH_ARCHIVE_PATH, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _archive_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{month}.json.gz")
+
+def load_archive_month(month: str) -> dict:
+    """Dữ liệu 1 tháng đã lưu trữ: {"hash": [...], "submit": {...}, "count": {...}, "past": {...}}."""
+    try:
+        with gzip.open(_archive_path(month), "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    for k, v in (("hash", []), ("submit", {}), ("count", {}), ("past", {})):
+        data.setdefault(k, v)
+    return data
+
+def _archive_merge(month: str, part: dict):
+    """Gộp phần dữ liệu cũ vào archive của tháng (chạy lại nhiều lần vẫn không trùng)."""
+    data = load_archive_month(month)
+    keys = {_wb_item_key(it) for it in data["hash"]}
+    for it in part["hash"]:
+        if _wb_item_key(it) not in keys:
+            keys.add(_wb_item_key(it))
+            data["hash"].append(it)
+    for day, ids in part["submit"].items():
+        arr = data["submit"].setdefault(day, [])
+        arr.extend(i for i in ids if i not in arr)
+    for day, per in part["count"].items():
+        cur = data["count"].setdefault(day, {})
+        for kid, c in per.items():
+            cur[kid] = max(int(cur.get(kid, 0)), int(c))
+    for day, entries in part["past"].items():
+        arr = data["past"].setdefault(day, [])
+        arr.extend(e for e in entries if e not in arr)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = _archive_path(month)
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def compact_storage(today: date = None) -> dict:
+    """Chuyển các ngày cũ hơn RETENTION_DAYS sang archive. Trả về thống kê (None nếu không áp dụng)."""
+    if STORAGE_BACKEND != "json" or RETENTION_DAYS <= 0:
+        return None
+    today = today or datetime.now(TZ).date()
+    cutoff = (today - timedelta(days=RETENTION_DAYS)).isoformat()
+
+    # 1) Chụp phần dữ liệu cũ (không xoá vội)
+    with _WB_LOCK:
+        dbs = _wb()["dbs"]
+        old_items = [it for it in dbs["hash"].get("items", []) if it.get("date") and it["date"] < cutoff]
+        snap = {name: {d: json.loads(json.dumps(v)) for d, v in dbs[name].items() if d < cutoff}
+                for name in ("submit", "count", "past")}
+    if not old_items and not any(snap.values()):
+        return {"items": 0, "days": 0}
+
+    # 2) Ghi archive theo tháng + chỉ mục md5 (ngoài khoá, có thể mất vài giây)
+    months = {}
+    for it in old_items:
+        months.setdefault(it["date"][:7], {"hash": [], "submit": {}, "count": {}, "past": {}})["hash"].append(it)
+    for name, per_day in snap.items():
+        for d, v in per_day.items():
+            months.setdefault(d[:7], {"hash": [], "submit": {}, "count": {}, "past": {}})[name][d] = v
+    for month, part in sorted(months.items()):
+        _archive_merge(month, part)
+    _hash_archive_append((it.get("hash"), it["date"]) for it in old_items if it.get("hash"))
+
+    # 3) Xoá khỏi RAM đúng phần đã chuyển (ngày nào vừa có thay đổi mới thì để lần sau)
+    moved = {id(it) for it in old_items}
+    with _WB_LOCK:
+        wb = _wb()
+        dbs = wb["dbs"]
+        dbs["hash"]["items"] = [it for it in dbs["hash"].get("items", []) if id(it) not in moved]
+        days = set()
+        for name, per_day in snap.items():
+            for d, v in per_day.items():
+                if dbs[name].get(d) == v:
+                    del dbs[name][d]
+                    days.add(d)
+        wb["dirty"] |= {"hash", "submit", "count", "past"}
+    _WB_EVENT.set()
+    logging.info("Lưu trữ: chuyển %d ảnh, %d ngày (trước %s) sang %s", len(old_items), len(days), cutoff, ARCHIVE_DIR)
+    return {"items": len(old_items), "days": len(days)}
+
+async def compact_storage_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(compact_storage)
+    except Exception:
+        logging.exception("Lỗi dọn dữ liệu cũ sang archive")
+
+def db_get_count(id_kho: str, d: date) -> int:
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            row = _sql_conn().execute(
+                "SELECT count FROM counts WHERE day = ? AND id_kho = ?", (d.isoformat(), str(id_kho))
+            ).fetchone()
+        return int(row[0]) if row else 0
+    with _WB_LOCK:
+        return get_count(_wb()["dbs"]["count"], str(id_kho), d)
+
+def db_submitted_ids(d: date) -> list:
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            rows = _sql_conn().execute("SELECT id_kho FROM submissions WHERE day = ?", (d.isoformat(),)).fetchall()
+        return [r[0] for r in rows]
+    with _WB_LOCK:
+        return list(_wb()["dbs"]["submit"].get(d.isoformat(), []))
+
+def db_day_counts(d: date) -> dict:
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            rows = _sql_conn().execute("SELECT id_kho, count FROM counts WHERE day = ?", (d.isoformat(),)).fetchall()
+        return {r[0]: int(r[1]) for r in rows}
+    with _WB_LOCK:
+        return dict(_wb()["dbs"]["count"].get(d.isoformat(), {}))
+
+def db_past_uses(d: date) -> list:
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            rows = _sql_conn().execute(
+                "SELECT id_kho, prev_date, hash FROM past_uses WHERE day = ? ORDER BY id", (d.isoformat(),)
+            ).fetchall()
+        return [{"id_kho": r[0], "prev_date": r[1], "hash": r[2]} for r in rows]
+    with _WB_LOCK:
+        return list(_wb()["dbs"]["past"].get(d.isoformat(), []))
+
 # ========= KHO MAP =========
+# Đọc Excel bằng openpyxl (read-only, không cần pandas). Kết quả lưu vào KHO_CACHE_PATH kèm mtime/kích thước/sha256
+# file Excel → lần khởi động sau (hoặc vòng restart) không phải mở lại Excel nếu file không đổi.
+# KHO_RELOAD_INTERVAL: chu kỳ (giây) kiểm tra file Excel; đổi nội dung thì nạp lại ở thread riêng và thay
+# bot_data["kho_map"] bằng dict mới (handler đang chạy vẫn dùng dict cũ, không phải chờ). 0 = tắt.
+import io
+from collections import deque
+
+KHO_CACHE_PATH = os.getenv("KHO_CACHE_PATH", ".kho_map.cache.json")
+KHO_RELOAD_INTERVAL = int(os.getenv("KHO_RELOAD_INTERVAL", "60"))
+_KHO_MAP_CACHE = None        # (chữ ký file Excel, sha256, kho_map)
+KHO_MAP_CHANGES = deque(maxlen=20)  # các lần nạp lại gần nhất: {"ts", "added", "removed", "renamed"}
+
+def _cell_str(v) -> str:
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)  # ô số 101.0 → "101" như id_kho trong caption
+    return str(v).strip()
+
+def _read_kho_excel(src) -> dict:
+    """src: đường dẫn hoặc file-like (bytes Excel)."""
+    from openpyxl import load_workbook
+    wb = load_workbook(src, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        cols = {str(c).lower().strip(): i for i, c in enumerate(header) if c is not None}
+        if "id_kho" not in cols or "ten_kho" not in cols:
+            raise RuntimeError("Excel phải có cột 'id_kho' và 'ten_kho'")
+        i_id, i_ten = cols["id_kho"], cols["ten_kho"]
+        kho_map = {}
+        for row in rows:
+            v_id = row[i_id] if i_id < len(row) else None
+            v_ten = row[i_ten] if i_ten < len(row) else None
+            if v_id is None or v_ten is None:
+                continue
+            kho_map[_cell_str(v_id)] = _cell_str(v_ten)
+        return kho_map
+    finally:
+        wb.close()
+
+def _kho_sig() -> list:
+    st = os.stat(EXCEL_PATH)
+    return [os.path.abspath(EXCEL_PATH), st.st_mtime_ns, st.st_size]
+
+def _kho_parse_file(sig: list):
+    """Đọc file Excel 1 lần: sha256 và kho_map tính trên cùng 1 bản bytes."""
+    with open(EXCEL_PATH, "rb") as f:
+        raw = f.read()
+    sha = hashlib.sha256(raw).hexdigest()
+    with span("kho_parse"):
+        kho_map = _read_kho_excel(io.BytesIO(raw))
+    return sha, kho_map
+
+def _kho_save_cache(sig: list, sha: str, kho_map: dict):
+    """Chỉ cache danh sách đã được chấp nhận; file rỗng/ghi dở không được cache (restart sẽ đọc lại Excel)."""
+    if not kho_map:
+        return
+    try:
+        _save_json(KHO_CACHE_PATH, {"sig": sig, "sha256": sha, "kho": kho_map})
+    except OSError:
+        pass
+
 def load_kho_map():
-    df = pd.read_excel(EXCEL_PATH)
-    cols = {c.lower().strip(): c for c in df.columns}
-    if "id_kho" not in cols or "ten_kho" not in cols:
-        raise RuntimeError("Excel phải có cột 'id_kho' và 'ten_kho'")
-    id_col = cols["id_kho"]; ten_col = cols["ten_kho"]
-    df = df[[id_col, ten_col]].dropna()
-    df[id_col] = df[id_col].astype(str).str.strip()
-    df[ten_col] = df[ten_col].astype(str).str.strip()
-    return dict(zip(df[id_col], df[ten_col]))
+    global _KHO_MAP_CACHE
+    sig = _kho_sig()
+    if _KHO_MAP_CACHE is not None and _KHO_MAP_CACHE[0] == sig:
+        return _KHO_MAP_CACHE[2]
+    cached = _load_json(KHO_CACHE_PATH, {})
+    if cached.get("sig") == sig and isinstance(cached.get("kho"), dict):
+        sha, kho_map = cached.get("sha256"), cached["kho"]
+    else:
+        sha, kho_map = _kho_parse_file(sig)
+        _kho_save_cache(sig, sha, kho_map)
+    _KHO_MAP_CACHE = (sig, sha, kho_map)
+    return kho_map
+
+def reload_kho_map(current: dict):
+    """
+    Nạp lại nếu file Excel đổi nội dung (mtime/kích thước đổi → so sha256 → so danh sách). Chạy ở thread riêng.
+    Trả về (kho_map mới, diff) hoặc None nếu không có gì thay đổi.
+    """
+    global _KHO_MAP_CACHE
+    sig = _kho_sig()
+    if _KHO_MAP_CACHE is not None and _KHO_MAP_CACHE[0] == sig:
+        return None
+    sha, new = _kho_parse_file(sig)
+    if _KHO_MAP_CACHE is not None and (_KHO_MAP_CACHE[1] == sha or new == current):
+        # chỉ đổi mtime (chép đè/touch) hoặc lưu lại Excel mà danh sách không đổi
+        _KHO_MAP_CACHE = (sig, sha, current)
+        _kho_save_cache(sig, sha, current)
+        return None
+    if not new:
+        raise RuntimeError("file Excel không có kho nào")
+    _KHO_MAP_CACHE = (sig, sha, new)
+    _kho_save_cache(sig, sha, new)
+    diff = {
+        "ts": datetime.now(TZ).isoformat(timespec="seconds"),
+        "added": sorted(set(new) - set(current)),
+        "removed": sorted(set(current) - set(new)),
+        "renamed": sorted(k for k in set(new) & set(current) if new[k] != current[k]),
+    }
+    return new, diff
+
+async def kho_map_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    current = context.bot_data.get("kho_map") or {}
+    try:
+        res = await asyncio.to_thread(reload_kho_map, current)
+    except Exception as e:
+        # file đang được ghi dở / lỗi định dạng → giữ danh sách cũ, lần sau thử lại
+        logging.warning("Không nạp lại được danh sách kho (%s): %r", EXCEL_PATH, e)
+        return
+    if res is None:
+        return
+    new, diff = res
+    context.bot_data["kho_map"] = new  # thay nguyên dict: người đang đọc dict cũ không bị ảnh hưởng
+    KHO_MAP_CHANGES.append(diff)
+    logging.info("Nạp lại danh sách kho: %d kho · thêm %s · bỏ %s · đổi tên %s",
+                 len(new), diff["added"] or "-", diff["removed"] or "-", diff["renamed"] or "-")
 
 # ========= PARSE TEXT =========
 ID_RX = re.compile(r"(\d{1,10})")
@@ -665,28 +2266,87 @@ def parse_text_for_id_and_date(text: str):
     return _id, _date
 
 # ========= GIỮ TEXT DÙNG CHUNG =========
-_last_text = {}  # chat_id -> (text, ts)
+_last_text = TTLCache("last_text", ttl=TEXT_PAIR_TIMEOUT)  # chat_id -> text (hết hạn sau TEXT_PAIR_TIMEOUT giây)
 
 def upsert_last_text(chat_id: int, text: str):
-    _last_text[chat_id] = (text, datetime.now(TZ).timestamp())
+    _last_text[chat_id] = text
 
 def get_last_text(chat_id: int):
-    data = _last_text.get(chat_id)
-    if not data:
-        return None
-    text, ts = data
-    if datetime.now(TZ).timestamp() - ts > TEXT_PAIR_TIMEOUT:
-        return None
-    return text
+    return _last_text.get(chat_id)
+
+
+# ========= IMAGE CONTEXT (decode 1 lần cho cả pipeline chấm điểm) =========
+# Vùng ảnh theo tỉ lệ (y0, y1, x0, x1) — cắt giống hệt gray[int(h*y0):int(h*y1), int(w*x0):int(w*x1)]
+FULL = (0.0, 1.0, 0.0, 1.0)
+LOWER = (0.55, 1.0, 0.0, 1.0)
+
+class ImageCtx:
+    """
+    Ảnh đã decode 1 lần + các mặt phẳng dẫn xuất (gray, blur, Canny, Laplacian)
+    tính lười và nhớ lại, để mọi hàm chấm điểm & pHash dùng chung.
+    Các mảng trả về là dùng chung: chỉ đọc, không ghi đè.
+    """
+    __slots__ = ("img", "_memo")
+
+    def __init__(self, photo_bytes=None, img_bgr=None):
+        if img_bgr is None:
+            img_bgr = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+        self.img = img_bgr
+        self._memo = {}
+
+    def memo(self, key, fn):
+        """Nhớ kết quả fn(ctx) theo key (dùng cho điểm chất lượng, điểm theo KV, pHash...)."""
+        try:
+            return self._memo[key]
+        except KeyError:
+            val = self._memo[key] = fn(self)
+            return val
+
+    @property
+    def gray(self):
+        g = self._memo.get("gray")
+        if g is None:
+            g = self._memo["gray"] = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        return g
+
+    def region(self, reg=FULL):
+        g = self.gray
+        if reg == FULL:
+            return g
+        h, w = g.shape
+        y0, y1, x0, x1 = reg
+        return g[int(h*y0):int(h*y1), int(w*x0):int(w*x1)]
+
+    def blur(self, reg=FULL, k=5):
+        return self.memo(("blur", reg, k), lambda c: cv2.GaussianBlur(c.region(reg), (k, k), 0))
+
+    def canny(self, t1=80, t2=200, reg=FULL):
+        return self.memo(("canny", reg, t1, t2), lambda c: cv2.Canny(c.region(reg), t1, t2))
+
+    def laplacian_var(self):
+        return self.memo("lap_var", lambda c: float(cv2.Laplacian(c.gray, cv2.CV_64F).var()))
+
+def _as_ctx(img) -> ImageCtx:
+    """Nhận ImageCtx / ảnh BGR đã decode / bytes ảnh → ImageCtx."""
+    if isinstance(img, ImageCtx):
+        return img
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        return ImageCtx(photo_bytes=img)
+    return ImageCtx(img_bgr=img)
+
+def _nonzero_ratio(mask) -> float:
+    return cv2.countNonZero(mask) / float(mask.size)
 
 
 # ========= 5S SCORING HELPERS (rule-based) =========
 def _score_quality_components(img_bgr):
+    ctx = _as_ctx(img_bgr)
+    img_bgr = ctx.img
     if img_bgr is None or img_bgr.size == 0:
         return 0.0, 0.0, 0.0, (0,0)
     h, w = img_bgr.shape[:2]
-    img_gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    sharp_val = float(cv2.Laplacian(img_gray, cv2.CV_64F).var())
+    img_gray = ctx.gray
+    sharp_val = ctx.laplacian_var()
     sharp_score = 1.0 if sharp_val >= LAPLACIAN_GOOD else max(0.0, sharp_val / LAPLACIAN_GOOD)
     mean_bright = float(img_gray.mean())
     if mean_bright < BRIGHT_MIN:
@@ -699,13 +2359,12 @@ def _score_quality_components(img_bgr):
     size_score = 1.0 if short_edge >= MIN_SHORT_EDGE else max(0.0, short_edge/MIN_SHORT_EDGE)
     return sharp_score, bright_score, size_score, (w,h)
 
-def _edge_density(img_gray, t1=80, t2=200):
-    edges = cv2.Canny(img_gray, t1, t2)
-    return float((edges>0).mean())
+def _edge_density(ctx: ImageCtx, t1=80, t2=200, reg=FULL):
+    return _nonzero_ratio(ctx.canny(t1, t2, reg))
 
 def _score_hanghoa(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 80, 200)
+    ctx = _as_ctx(img_bgr)
+    edges = ctx.canny(80, 200)
     lines = cv2.HoughLines(edges, 1, np.pi/180, 120)
     angles = []
     if lines is not None:
@@ -719,55 +2378,49 @@ def _score_hanghoa(img_bgr):
         align_score = float(max(0.0, 1.0 - (devs.mean()/(np.pi/8))))
     else:
         align_score = 0.6
-    clutter = _edge_density(gray)  # 0..1
+    clutter = _edge_density(ctx)  # 0..1
     tidy_score = float(max(0.0, 1.0 - min(clutter/0.25, 1.0)))
-    h, w = gray.shape
-    lower = gray[int(h*0.55):, :]
-    lower_edges = cv2.Canny(lower, 80, 200)
-    empty_ratio = 1.0 - float((lower_edges>0).mean())
+    empty_ratio = 1.0 - _edge_density(ctx, reg=LOWER)
     aisle_score = float(max(0.0, min(empty_ratio, 1.0)))
     return {"align": align_score, "tidy": tidy_score, "aisle": aisle_score}
 
 def _score_wc(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    ctx = _as_ctx(img_bgr)
+    gray = ctx.gray
     k = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7,7))
     blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, k)
     _, th = cv2.threshold(blackhat, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    stain_ratio = float((th>0).mean())
+    stain_ratio = _nonzero_ratio(th)
     stain_score = float(max(0.0, 1.0 - min(stain_ratio/0.10, 1.0)))
     h, w = gray.shape
-    lower = gray[int(h*0.55):, :]
-    lower_blur = cv2.GaussianBlur(lower, (5,5), 0)
+    lower_blur = ctx.blur(LOWER)
     _, lower_th = cv2.threshold(lower_blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     cnts, _ = cv2.findContours(lower_th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     small_blobs = [c for c in cnts if 10 <= cv2.contourArea(c) <= 500]
     trash_density = float(len(small_blobs)) / max(1.0, (w*h/10000.0))
     trash_score = float(max(0.0, 1.0 - min(trash_density/1.5, 1.0)))
-    lap = cv2.Laplacian(gray, cv2.CV_64F)
-    local_var = float(np.var(lap))
+    local_var = ctx.laplacian_var()
     dry_score = float(max(0.0, 1.0 - min(local_var/500.0, 1.0)))
     return {"stain": stain_score, "trash": trash_score, "dry": dry_score}
 
 def _score_khobai(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (5,5), 0)
+    ctx = _as_ctx(img_bgr)
+    blur = ctx.blur()
     _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    dirt_ratio = float((th == 0).mean())
+    dirt_ratio = (th.size - cv2.countNonZero(th)) / float(th.size)
     clean_score = float(max(0.0, 1.0 - min(dirt_ratio/0.20, 1.0)))
-    h, w = gray.shape
-    band = gray[int(h*0.45):int(h*0.75), :]
-    obs_density = _edge_density(band)
+    obs_density = _edge_density(ctx, reg=(0.45, 0.75, 0.0, 1.0))
     obstacle_score = float(max(0.0, 1.0 - min(obs_density/0.30, 1.0)))
-    edges = cv2.Canny(gray, 80, 200)
+    edges = ctx.canny(80, 200)
     lines = cv2.HoughLines(edges, 1, np.pi/180, 150)
     line_score = 0.6 if lines is None else 1.0
     return {"clean": clean_score, "obstacle": obstacle_score, "line": float(line_score)}
 
 def _score_vanphong(img_bgr):
-    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    ctx = _as_ctx(img_bgr)
+    gray = ctx.gray
     h, w = gray.shape
-    band = gray[int(h*0.25):int(h*0.75), int(w*0.10):int(w*0.90)]
-    band_blur = cv2.GaussianBlur(band, (5,5), 0)
+    band_blur = ctx.blur((0.25, 0.75, 0.10, 0.90))
     _, band_th = cv2.threshold(band_blur, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     cnts, _ = cv2.findContours(band_th, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     small_items = [c for c in cnts if 20 <= cv2.contourArea(c) <= 1500]
@@ -776,11 +2429,9 @@ def _score_vanphong(img_bgr):
     k = cv2.getStructuringElement(cv2.MORPH_RECT, (7,7))
     blackhat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, k)
     _, th = cv2.threshold(blackhat, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    dirty_ratio = float((th>0).mean())
+    dirty_ratio = _nonzero_ratio(th)
     surface_clean = float(max(0.0, 1.0 - min(dirty_ratio/0.15, 1.0)))
-    margin = gray[:, :int(w*0.20)]
-    edges = cv2.Canny(margin, 60, 160)
-    cable_density = float((edges>0).mean())
+    cable_density = _edge_density(ctx, 60, 160, reg=(0.0, 1.0, 0.0, 0.20))
     cable = float(max(0.0, 1.0 - min(cable_density/0.35, 1.0)))
     return {"desk_tidy": desk_tidy, "surface_clean": surface_clean, "cable": cable}
 
@@ -796,19 +2447,21 @@ def _kv_key_from_text(kv_text):
         return "VanPhong"
     return "HangHoa"  # default
 
-def _score_by_kv(photo_bytes: bytes, kv_text: str):
-    img = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
+_KV_SCORERS = {
+    "HangHoa": _score_hanghoa,
+    "WC": _score_wc,
+    "KhoBai": _score_khobai,
+    "VanPhong": _score_vanphong,
+}
+
+def _score_by_kv(photo, kv_text: str):
+    """photo: bytes ảnh hoặc ImageCtx. Kết quả được nhớ trên ctx nên gọi lại không tốn thêm."""
+    ctx = _as_ctx(photo)
     kv_key = _kv_key_from_text(kv_text)
-    if kv_key == "HangHoa":
-        parts = _score_hanghoa(img)
-    elif kv_key == "WC":
-        parts = _score_wc(img)
-    elif kv_key == "KhoBai":
-        parts = _score_khobai(img)
-    else:
-        parts = _score_vanphong(img)
+    if kv_key not in _KV_SCORERS:
         kv_key = "VanPhong"
-    return parts, kv_key
+    parts = ctx.memo(("parts", kv_key), _KV_SCORERS[kv_key])
+    return dict(parts), kv_key
 
 def _diagnose(kv_key: str, parts: dict):
     th = AREA_RULE_THRESHOLDS.get(kv_key, _AREA_RULE_THRESHOLDS[kv_key])
@@ -845,19 +2498,12 @@ def _diagnose(kv_key: str, parts: dict):
         if parts.get("cable",1) < th["cable"]:
             issues.append("Dây điện/cáp lộn xộn"); recs.append("Dùng kẹp/ống bọc dây; gom dây về một mép bàn/đế cố định")
     return issues, recs
-def apply_scoring_rule(photo_bytes: bytes, kv_text: str, is_duplicate: bool=False):
-    img = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_COLOR)
-    sharp_s, bright_s, size_s, (w,h) = _score_quality_components(img)
+def apply_scoring_rule(photo_bytes, kv_text: str, is_duplicate: bool=False):
+    """photo_bytes: bytes ảnh hoặc ImageCtx dùng chung với apply_scoring_struct."""
+    ctx = _as_ctx(photo_bytes)
+    sharp_s, bright_s, size_s, (w,h) = ctx.memo("quality", _score_quality_components)
     q_score = 0.2 * (0.6*sharp_s + 0.4*bright_s)
-    kv_key = _kv_key_from_text(kv_text)
-    if kv_key == "HangHoa":
-        parts = _score_hanghoa(img)
-    elif kv_key == "WC":
-        parts = _score_wc(img)
-    elif kv_key == "KhoBai":
-        parts = _score_khobai(img)
-    else:
-        parts = _score_vanphong(img)
+    parts, kv_key = _score_by_kv(ctx, kv_text)
     weights = AREA_RULE_WEIGHTS.get(kv_key, _DEFAULT_WEIGHTS[kv_key])
     total_w = float(sum(weights.values())) or 100.0
     content_s = 0.0
@@ -881,6 +2527,225 @@ def apply_scoring_rule(photo_bytes: bytes, kv_text: str, is_duplicate: bool=Fals
         f"- Chất lượng: nét {sharp_s:.2f} · sáng {bright_s:.2f} · kích thước {w}×{h}"
     )
     return text
+
+# ========= SCORING SERVICE (process pool, không chặn event loop) =========
+# SCORING_WORKERS   : số process chấm điểm (0 = chạy trong thread của asyncio)
+# SCORING_QUEUE_MAX : số ảnh tối đa đang chờ/chấm cùng lúc; vượt quá thì bỏ qua chấm điểm ảnh đó
+# SCORING_TIMEOUT   : giây tối đa cho 1 ảnh; quá hạn thì bỏ qua (ảnh vẫn được ghi nhận bình thường)
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", "2"))
+SCORING_QUEUE_MAX = int(os.getenv("SCORING_QUEUE_MAX", "32"))
+SCORING_TIMEOUT = float(os.getenv("SCORING_TIMEOUT", "30"))
+
+_SCORING_POOL = None
+_SCORING_INFLIGHT = 0
+
+def _scoring_pool() -> ProcessPoolExecutor:
+    global _SCORING_POOL
+    if _SCORING_POOL is None:
+        # spawn: process con không thừa hưởng lock/thread của bot (job queue, httpx...)
+        _SCORING_POOL = ProcessPoolExecutor(
+            max_workers=SCORING_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            # worker nạp OpenCV ngay khi khởi động (không đợi ảnh đầu tiên) + chờ cờ bật profiler
+            initializer=_scoring_worker_init,
+            initargs=_profile_worker_args(),
+        )
+    return _SCORING_POOL
+
+def shutdown_scoring_pool():
+    global _SCORING_POOL
+    pool, _SCORING_POOL = _SCORING_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _scoring_worker(photo_bytes: bytes, kv_text: str) -> dict:
+    return extract_scoring_features(photo_bytes, kv_text)
+
+def _scoring_done(fut):
+    """Ảnh thật sự rời worker (xong/lỗi/huỷ khi còn chờ) → giải phóng 1 chỗ trong SCORING_QUEUE_MAX."""
+    global _SCORING_INFLIGHT
+    _SCORING_INFLIGHT -= 1
+    if not fut.cancelled():
+        fut.exception()  # đã bỏ chờ vì quá hạn: lấy lỗi ra để asyncio không cảnh báo
+
+async def score_photo_async(photo_bytes: bytes, kv_text: str):
+    """
+    Gửi ảnh sang worker chấm điểm và chờ kết quả (features cho finish_scoring_struct).
+    Trả về None nếu hàng đợi đầy, quá hạn hoặc worker lỗi.
+    """
+    global _SCORING_INFLIGHT
+    if _SCORING_INFLIGHT >= SCORING_QUEUE_MAX:
+        logging.warning("Hàng đợi chấm điểm đầy (%d) → bỏ qua chấm điểm ảnh này", _SCORING_INFLIGHT)
+        inc("bot5s_scoring_skipped_total", reason="queue_full")
+        return None
+    try:
+        with span("score_photo"):
+            if SCORING_WORKERS > 0:
+                fut = asyncio.get_running_loop().run_in_executor(_scoring_pool(), _scoring_worker, photo_bytes, kv_text)
+            else:
+                fut = asyncio.ensure_future(asyncio.to_thread(_scoring_worker, photo_bytes, kv_text))
+            # quá hạn không dừng được worker đang chạy: chỉ đếm giảm khi worker thật sự xong (_scoring_done)
+            _SCORING_INFLIGHT += 1
+            fut.add_done_callback(_scoring_done)
+            return await asyncio.wait_for(asyncio.shield(fut), timeout=SCORING_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Chấm điểm quá %.0fs → bỏ qua", SCORING_TIMEOUT)
+        inc("bot5s_scoring_skipped_total", reason="timeout")
+        return None
+    except BrokenProcessPool:
+        logging.exception("Process chấm điểm bị lỗi → tạo lại pool")
+        inc("bot5s_scoring_skipped_total", reason="error")
+        shutdown_scoring_pool()
+        return None
+    except Exception:
+        logging.exception("Lỗi chấm điểm ảnh")
+        inc("bot5s_scoring_skipped_total", reason="error")
+        return None
+# ========= PROFILER (lấy mẫu stack theo yêu cầu: /profile_start, /profile_stop) =========
+# Thread lấy mẫu sys._current_frames() PROFILE_HZ lần/giây cho mọi thread của bot (event loop, thread ghi nền...)
+# và main thread của từng worker chấm điểm (bật/tắt qua 1 multiprocessing.Event truyền lúc tạo pool).
+# Kết quả dạng "collapsed stack" (mỗi dòng: thread;hàm;hàm... số_mẫu) — mở bằng speedscope.app hoặc flamegraph.pl.
+# PROFILE_MAX_SECONDS: tự dừng nếu quên /profile_stop.
+PROFILE_HZ = float(os.getenv("PROFILE_HZ", "100"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+_PROFILE = {"sampler": None, "flag": None, "dir": None}
+_FRAME_LABELS = {}  # code object -> "hàm (file:dòng)"
+
+def _frame_label(code) -> str:
+    label = _FRAME_LABELS.get(code)
+    if label is None:
+        label = _FRAME_LABELS[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+class StackSampler:
+    """Thread lấy mẫu stack định kỳ, gộp số mẫu theo stack (thread_ids=None: mọi thread trừ chính nó)."""
+
+    def __init__(self, hz: float = PROFILE_HZ, thread_ids=None, label: str | None = None):
+        self.interval = 1.0 / max(hz, 1.0)
+        self.thread_ids, self.label = thread_ids, label
+        self.counts = Counter()
+        self.samples = 0
+        self.started = self.stopped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        me, names = threading.get_ident(), {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if any(tid not in names for tid in frames):
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in frames.items():
+                if tid == me or (self.thread_ids is not None and tid not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(self.label or names.get(tid, str(tid)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        self.stopped = time.time()
+        return self.counts
+
+def render_collapsed(counts: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def _profile_worker_args() -> tuple:
+    """
+    (cờ bật lấy mẫu, thư mục kết quả) truyền cho worker chấm điểm lúc tạo pool.
+    Thư mục chỉ được tạo khi /profile_start và xoá khi /profile_stop (không dùng profiler thì không tạo gì).
+    """
+    if _PROFILE["flag"] is None:
+        _PROFILE["flag"] = multiprocessing.get_context("spawn").Event()
+        _PROFILE["dir"] = os.path.join(tempfile.gettempdir(), f"bot5s-profile-{os.getpid()}")
+    return _PROFILE["flag"], _PROFILE["dir"]
+
+def _profile_cleanup():
+    if _PROFILE["dir"]:
+        shutil.rmtree(_PROFILE["dir"], ignore_errors=True)
+
+def _scoring_worker_init(flag=None, out_dir=None):
+    """Initializer của worker chấm điểm: nạp OpenCV ngay + thread lấy mẫu chờ cờ profile."""
+    _import_cv()
+    if flag is not None:
+        threading.Thread(target=_worker_profile_loop, args=(flag, out_dir), name="profiler", daemon=True).start()
+
+def _worker_profile_loop(flag, out_dir: str):
+    main_id = threading.main_thread().ident
+    while True:
+        flag.wait()
+        sampler = StackSampler(thread_ids={main_id}, label="scoring-worker").start()
+        while flag.is_set():
+            time.sleep(0.05)
+        text = render_collapsed(sampler.stop())
+        path = os.path.join(out_dir, f"worker-{os.getpid()}.collapsed")
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass  # bot đã dừng profile/xoá thư mục trước khi worker kịp ghi
+
+def profile_start() -> bool:
+    """Bắt đầu lấy mẫu; False nếu đang chạy."""
+    if _PROFILE["sampler"] is not None:
+        return False
+    if SCORING_ENABLED and SCORING_WORKERS > 0:
+        flag, out_dir = _profile_worker_args()
+        _profile_cleanup()  # bỏ kết quả sót của lần trước
+        os.makedirs(out_dir, exist_ok=True)
+        flag.set()
+    _PROFILE["sampler"] = StackSampler().start()
+    return True
+
+async def profile_stop():
+    """Dừng lấy mẫu, gộp kết quả của worker. Trả về (Counter, StackSampler, số worker) hoặc None nếu chưa chạy."""
+    sampler, _PROFILE["sampler"] = _PROFILE["sampler"], None
+    if sampler is None:
+        return None
+    counts = await asyncio.to_thread(sampler.stop)
+    n_workers = 0
+    if _PROFILE["flag"] is not None and _PROFILE["flag"].is_set():
+        _PROFILE["flag"].clear()
+        expected = SCORING_WORKERS if _SCORING_POOL is not None else 0
+        files = []
+        for _ in range(40):  # chờ worker ghi kết quả (tối đa ~2s)
+            files = glob.glob(os.path.join(_PROFILE["dir"], "*.collapsed"))
+            if len(files) >= expected:
+                break
+            await asyncio.sleep(0.05)
+        for p in files:
+            with open(p, encoding="utf-8") as f:
+                for line in f:
+                    stack, _, n = line.rstrip("\n").rpartition(" ")
+                    if stack:
+                        counts[stack] += int(n)
+        n_workers = len(files)
+        _profile_cleanup()
+    return counts, sampler, n_workers
+
+def top_self(counts: Counter, k: int = 5) -> list:
+    """Các hàm tốn nhiều mẫu nhất (khung trên cùng của stack)."""
+    own = Counter()
+    for stack, n in counts.items():
+        own[stack.rsplit(";", 1)[-1]] += n
+    return own.most_common(k)
+
 # ========= SUBMISSION/COUNTS =========
 def mark_submitted(submit_db, id_kho: str, d: date):
     key = d.isoformat()
@@ -902,47 +2767,218 @@ def get_count(count_db, id_kho: str, d: date) -> int:
 
 # ========= PAST-USE LOG =========
 def log_past_use(id_kho: str, prev_date: str, h: str, today: date):
-    db = load_past_db()
-    key = today.isoformat()
-    arr = db.get(key, [])
-    arr.append({"id_kho": id_kho, "prev_date": prev_date, "hash": h})
-    db[key] = arr
-    save_past_db(db)
+    if STORAGE_BACKEND == "sqlite":
+        with _SQL_LOCK:
+            conn = _sql_conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO past_uses(day, id_kho, prev_date, hash) VALUES (?, ?, ?, ?)",
+                    (today.isoformat(), id_kho, prev_date, h)
+                )
+    else:
+        _wb_mutate({"op": "past", "day": today.isoformat(),
+                    "entry": {"id_kho": id_kho, "prev_date": prev_date, "hash": h}})
+    day_agg_on_past(id_kho, prev_date, today)
+
+# ========= TỔNG HỢP THEO NGÀY (cho báo cáo 21:00 và /report_now) =========
+# Cập nhật ngay khi ghi nhận ảnh/ảnh quá khứ; báo cáo chỉ đọc từ đây, không quét lại DB.
+# Ngày chưa có trong DAY_AGG (vd. vừa restart) được dựng 1 lần từ dữ liệu đúng ngày đó.
+DAY_AGG_KEEP_DAYS = 7
+DAY_AGG = {}  # {'YYYY-MM-DD': {'submitted': set, 'counts': {id: n}, 'past': {id: ngày sớm nhất},
+              #                 'under': set(0 < n < REQUIRED_PHOTOS), 'missing': set|None, 'kho_map': dict|None}}
+
+def day_agg(d: date) -> dict:
+    key = d.isoformat()
+    agg = DAY_AGG.get(key)
+    if agg is None:
+        counts = {str(k): int(v) for k, v in db_day_counts(d).items()}
+        past = {}
+        for it in db_past_uses(d):
+            kid, prev = it.get("id_kho"), it.get("prev_date")
+            if kid and prev:
+                past[kid] = min(past.get(kid, prev), prev)
+        agg = DAY_AGG[key] = {
+            "submitted": set(db_submitted_ids(d)), "counts": counts, "past": past,
+            "under": {k for k, c in counts.items() if 0 < c < REQUIRED_PHOTOS},
+            "missing": None, "kho_map": None,
+        }
+        cutoff = (d - timedelta(days=DAY_AGG_KEEP_DAYS)).isoformat()
+        for old in [k for k in DAY_AGG if k < cutoff]:
+            del DAY_AGG[old]
+    return agg
+
+def day_agg_missing(agg: dict, kho_map: dict) -> set:
+    """Các kho chưa nộp; tính lại toàn bộ chỉ khi danh sách kho đổi."""
+    if agg["kho_map"] is not kho_map:
+        agg["missing"] = set(kho_map) - agg["submitted"]
+        agg["kho_map"] = kho_map
+    return agg["missing"]
+
+def day_agg_on_photo(id_kho: str, day: str, count: int):
+    agg = day_agg(date.fromisoformat(day))
+    agg["submitted"].add(id_kho)
+    agg["counts"][id_kho] = count
+    if 0 < count < REQUIRED_PHOTOS:
+        agg["under"].add(id_kho)
+    else:
+        agg["under"].discard(id_kho)
+    if agg["missing"] is not None:
+        agg["missing"].discard(id_kho)
+
+def day_agg_on_past(id_kho: str, prev_date: str, d: date):
+    if id_kho and prev_date:
+        past = day_agg(d)["past"]
+        past[id_kho] = min(past.get(id_kho, prev_date), prev_date)
 
 # ========= GỘP TIN NHẮN TIẾN ĐỘ (mỗi kho/mỗi ngày 1 tin) =========
-PROGRESS_MSG = {}  # {(chat_id, id_kho, yyyy-mm-dd): {'msg_id': int|None, 'lines': list[str]}}
+PROGRESS_MSG = TTLCache("progress_msg", ttl=36 * 3600)  # {(chat_id, id_kho, yyyy-mm-dd): {'msg_id': int|None, 'lines': list[str], 'sent_text': str}}
 
 def day_key(d: date) -> str:
     return d.isoformat()  # YYYY-MM-DD
 
-async def ack_photo_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int, id_kho: str, ten_kho: str, d: date, cur_count: int):
+async def ack_photo_progress(context: ContextTypes.DEFAULT_TYPE, chat_id: int, id_kho: str, ten_kho: str, d: date, cur_count):
     """
     Gom toàn bộ tiến độ gửi ảnh của 1 kho trong 1 ngày vào 1 tin nhắn.
     Không còn câu 'Còn thiếu X ảnh'.
     Khi đủ REQUIRED_PHOTOS ảnh thì thêm dòng 'ĐÃ ĐỦ ... Cảm ơn bạn!'.
+    cur_count: số đếm sau 1 ảnh, hoặc list số đếm sau từng ảnh của 1 album (mỗi ảnh 1 dòng, 1 lần cập nhật tin).
     """
     key = (chat_id, str(id_kho), day_key(d))
     state = PROGRESS_MSG.setdefault(key, {'msg_id': None, 'lines': []})
     date_text = d.strftime("%d/%m/%Y")
 
-    if cur_count < REQUIRED_PHOTOS:
-        line = f"✅ Đã ghi nhận ảnh {cur_count}/{REQUIRED_PHOTOS} cho {ten_kho} (ID {id_kho}) - Ngày {date_text}."
-    else:
-        line = f"✅ ĐÃ ĐỦ {REQUIRED_PHOTOS}/{REQUIRED_PHOTOS} ảnh cho {ten_kho} (ID {id_kho}) - Ngày {date_text}. Cảm ơn bạn!"
+    for c in ([cur_count] if isinstance(cur_count, int) else cur_count):
+        if c < REQUIRED_PHOTOS:
+            line = f"✅ Đã ghi nhận ảnh {c}/{REQUIRED_PHOTOS} cho {ten_kho} (ID {id_kho}) - Ngày {date_text}."
+        else:
+            line = f"✅ ĐÃ ĐỦ {REQUIRED_PHOTOS}/{REQUIRED_PHOTOS} ảnh cho {ten_kho} (ID {id_kho}) - Ngày {date_text}. Cảm ơn bạn!"
+        state['lines'].append(line)
+    # không chờ gửi xong: các lần cập nhật dồn trong lúc chờ lượt gửi chỉ tốn 1 lần gọi API (nội dung mới nhất)
+    OUTBOX.submit(chat_id, lambda: _flush_progress(context.bot, chat_id, state), PRIO_ACK, key=("progress",) + key)
 
-    state['lines'].append(line)
+async def _flush_progress(bot, chat_id: int, state: dict):
+    """Gửi/sửa tin tiến độ theo nội dung mới nhất lúc tới lượt gửi."""
     text = "\n".join(state['lines'])
-
+    if text == state.get('sent_text'):
+        return
     if state['msg_id'] is None:
-        m = await safe_send_message(context.bot, chat_id=chat_id, text=text, disable_web_page_preview=True)
+        m = await bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
         state['msg_id'] = m.message_id
     else:
         try:
-            await safe_edit_message_text(context.bot, chat_id=chat_id, message_id=state['msg_id'],
-                                                text=text, disable_web_page_preview=True)
+            await bot.edit_message_text(chat_id=chat_id, message_id=state['msg_id'],
+                                        text=text, disable_web_page_preview=True)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():  # nội dung trên Telegram đã đúng
+                state['sent_text'] = text
+                return
+            # tin tiến độ đã bị xoá/không sửa được nữa → gửi tin mới
+            m = await bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
+            state['msg_id'] = m.message_id
+        except (RetryAfter, NetworkError):
+            raise  # RetryAfter/TimedOut/lỗi mạng: để OUTBOX lên lịch gửi lại, không gửi tin mới
         except Exception:
-            m = await safe_send_message(context.bot, chat_id=chat_id, text=text, disable_web_page_preview=True)
+            m = await bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
             state['msg_id'] = m.message_id
+    state['sent_text'] = text
+
+# ========= TẢI ẢNH =========
+# PHOTO_MAX_SIDE     : cạnh dài tối đa của bản ảnh được tải (0 = bản lớn nhất như trước)
+# SCORING_PHOTO_SIDE : bản ảnh cỡ vừa đủ cho chấm điểm/pHash khi không cần tải ảnh để lấy MD5
+# PHOTO_ID_MODE      : md5 (mặc định, MD5 nội dung ảnh) | file_unique_id (định danh Telegram, không cần tải ảnh)
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "0"))
+SCORING_PHOTO_SIDE = int(os.getenv("SCORING_PHOTO_SIDE", "1280"))
+PHOTO_ID_MODE = os.getenv("PHOTO_ID_MODE", "md5").strip().lower() or "md5"
+
+def _scoring_photo_side() -> int:
+    return min(SCORING_PHOTO_SIDE, PHOTO_MAX_SIDE) if PHOTO_MAX_SIDE > 0 else SCORING_PHOTO_SIDE
+
+def pick_photo_size(sizes, max_side: int):
+    """Bản PhotoSize lớn nhất có cạnh dài ≤ max_side (0 = lớn nhất); không bản nào vừa thì lấy bản nhỏ nhất."""
+    if not sizes:
+        return None
+    if max_side <= 0:
+        return sizes[-1]
+    fit = [p for p in sizes if max(p.width, p.height) <= max_side]
+    if not fit:
+        return min(sizes, key=lambda p: p.width * p.height)
+    return max(fit, key=lambda p: p.width * p.height)
+
+async def download_photo(bot, photo_size) -> bytes:
+    """Tải 1 bản ảnh vào bộ nhớ, dùng luôn buffer HTTP trả về (không copy sang bytearray/bytes)."""
+    with span("get_file"):
+        tg_file = await bot.get_file(photo_size.file_id)
+    with span("download"):
+        if tg_file.file_path and tg_file.file_path.startswith(("http://", "https://")):
+            return await bot.request.retrieve(tg_file.file_path)
+        return bytes(await tg_file.download_as_bytearray())
+
+# ========= KHOÁ THEO KHO (song song giữa các kho, tuần tự trong 1 kho/ngày) =========
+# CONCURRENT_UPDATES: số update Telegram xử lý cùng lúc (<= 1 = tuần tự như trước)
+from contextlib import asynccontextmanager
+
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+_KEY_LOCKS = {}  # key -> [asyncio.Lock, số coroutine đang giữ/chờ]
+
+@asynccontextmanager
+async def key_lock(key):
+    """asyncio.Lock theo key (FIFO), tự dọn khi không còn ai dùng."""
+    ent = _KEY_LOCKS.get(key)
+    if ent is None:
+        ent = _KEY_LOCKS[key] = [asyncio.Lock(), 0]
+    ent[1] += 1
+    try:
+        async with ent[0]:
+            yield
+    finally:
+        ent[1] -= 1
+        if ent[1] == 0:
+            _KEY_LOCKS.pop(key, None)
+
+# ========= ALBUM COLLECTOR (gom ảnh cùng media_group_id, xử lý 1 lô) =========
+# ALBUM_WINDOW: số giây chờ thêm ảnh của album sau ảnh cuối cùng nhận được (0 = xử lý từng ảnh như trước)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))
+ALBUM_BUFFER = TTLCache("album_buffer", ttl=600)     # {(chat_id, media_group_id): {'msgs': list[(Message, caption, last_text)], 'job': Job}}
+ALBUM_CAPTIONS = TTLCache("album_captions", ttl=600)  # {(chat_id, media_group_id): caption của album}
+ALBUM_HASHES = TTLCache("album_hashes", ttl=600)      # {(chat_id, media_group_id): set(md5) đã nhận trong album}
+
+def album_collect(context: ContextTypes.DEFAULT_TYPE, msg):
+    """Thêm ảnh vào lô của album, hẹn xử lý sau ALBUM_WINDOW giây kể từ ảnh mới nhất."""
+    key = (msg.chat_id, msg.media_group_id)
+    ent = ALBUM_BUFFER.setdefault(key, {"msgs": [], "job": None})
+    # chốt text đã lưu ngay lúc ảnh đến (như xử lý từng ảnh), không đọc lại lúc job chạy
+    caption = msg.caption.strip() if msg.caption else ""
+    ent["msgs"].append((msg, caption, get_last_text(msg.chat_id) or ""))
+    if ent["job"]:
+        try:
+            ent["job"].schedule_removal()
+        except Exception:
+            pass
+    ent["job"] = context.job_queue.run_once(
+        _album_job, when=ALBUM_WINDOW, data=key, chat_id=msg.chat_id,
+        name=f"album_{msg.chat_id}_{msg.media_group_id}"
+    )
+
+async def _album_job(context: ContextTypes.DEFAULT_TYPE):
+    key = context.job.data
+    ent = ALBUM_BUFFER.pop(key, None)
+    if not ent:
+        return
+    items = sorted(ent["msgs"], key=lambda it: it[0].message_id)
+
+    # caption của album (thường nằm ở ảnh đầu); ảnh đến muộn (lô sau) vẫn dùng lại được
+    album_caption = ALBUM_CAPTIONS.get(key) or next((c for _, c, _ in items if c), "")
+    if album_caption:
+        ALBUM_CAPTIONS[key] = album_caption
+
+    # mỗi ảnh: caption riêng → caption album → text đã lưu lúc ảnh đến; rồi gom theo (kho, ngày)
+    groups = {}
+    for msg, caption, last_text in items:
+        caption_from_group = caption or album_caption or last_text
+        g = groups.setdefault(parse_text_for_id_and_date(caption_from_group), (caption_from_group, []))
+        g[1].append(msg)
+
+    await asyncio.gather(*(_handle_photos(context, msgs, cap) for cap, msgs in groups.values()))
 
 # ========= HANDLERS =========
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -955,17 +2991,83 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "➡️ Mẹo: Gửi 1 tin nhắn text có ID/Ngày rồi gửi nhiều ảnh liên tiếp (không caption) — bot sẽ áp cùng caption 2 phút.\n\n"
         "Lệnh: `/chatid` lấy chat id, `/report_now` gửi báo cáo ngay."
     )
-    await update.effective_message.reply_text(msg)
+    safe_reply_text(update.effective_message, msg)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await cmd_start(update, context)
 
 async def chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_message.reply_text(str(update.effective_chat.id))
+    safe_reply_text(update.effective_message, str(update.effective_chat.id))
 
 async def report_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_daily_report(context)
-    await update.effective_message.reply_text("✅ Đã gửi báo cáo 5S mới nhất vào các group cấu hình.")
+    # gửi báo cáo ở task riêng: handler không chờ hàng đợi gửi tin
+    context.application.create_task(send_daily_report(context), update=update)
+    safe_reply_text(update.effective_message, "✅ Đang gửi báo cáo 5S mới nhất vào các group cấu hình.")
+
+def format_stats() -> str:
+    """Tóm tắt METRICS cho lệnh /stats."""
+    hists, counters, collected = metrics_snapshot()
+    up = int(time.time() - STARTED_AT)
+    lines = [f"📊 Thống kê bot · chạy {up // 3600}h{up % 3600 // 60:02d}m"]
+    photos = {dict(lb).get("result"): v for (n, lb), v in counters.items() if n == "bot5s_photos_total"}
+    if photos:
+        lines.append("Ảnh: " + " · ".join(f"{k}={v}" for k, v in sorted(photos.items(), key=lambda kv: -kv[1])))
+    lines.append("Gửi tin: " + " · ".join(f"{k}={v}" for k, v in OUTBOX.stats.items()) + f" · đang chờ={OUTBOX.pending()}")
+    jobs = {dict(lb).get("job"): v for (n, lb), v in counters.items() if n == "bot5s_jobs_run_total"}
+    if jobs:
+        lines.append("Job đã chạy: " + " · ".join(f"{k}={v}" for k, v in sorted(jobs.items())))
+    skipped = {dict(lb).get("reason"): v for (n, lb), v in counters.items() if n == "bot5s_scoring_skipped_total"}
+    if skipped:
+        lines.append("Bỏ qua chấm điểm: " + " · ".join(f"{k}={v}" for k, v in sorted(skipped.items())))
+    lines.append("Bộ nhớ tạm: " + " · ".join(f"{k}={v['size']}" for k, v in cache_stats().items()))
+    stages = [(dict(lb), b, total, count) for (n, lb), (b, total, count) in hists.items() if n == "bot5s_stage_seconds"]
+    if stages:
+        lines.append("Thời gian (ms p50/p95/p99 · số lần · tổng s):")
+        for lb, b, total, count in sorted(stages, key=lambda x: -x[2])[:20]:
+            name = lb.pop("stage") + "".join(f" {v}" for v in lb.values())
+            p50, p95, p99 = (hist_quantile(b, q) * 1000 for q in (0.5, 0.95, 0.99))
+            lines.append(f"- {name}: {p50:.0f}/{p95:.0f}/{p99:.0f} · {count} · {total:.1f}")
+    return "\n".join(lines)
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    safe_reply_text(update.effective_message, format_stats())
+
+async def cmd_profile_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile_start [giây] — bắt đầu lấy mẫu stack (tự dừng sau số giây, tối đa PROFILE_MAX_SECONDS)."""
+    secs = PROFILE_MAX_SECONDS
+    if context.args and context.args[0].isdigit():
+        secs = max(1, min(int(context.args[0]), PROFILE_MAX_SECONDS))
+    if not profile_start():
+        safe_reply_text(update.effective_message, "⚠️ Profiler đang chạy. Dùng /profile_stop để dừng và nhận kết quả.")
+        return
+    context.job_queue.run_once(_profile_auto_stop, when=secs, data=update.effective_chat.id, name="profile_auto_stop")
+    safe_reply_text(update.effective_message,
+        f"⏺ Đang lấy mẫu {PROFILE_HZ:g} lần/giây (bot + worker chấm điểm). /profile_stop để dừng, tự dừng sau {secs}s.")
+
+async def cmd_profile_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    for job in context.job_queue.get_jobs_by_name("profile_auto_stop"):
+        job.schedule_removal()
+    if not await _send_profile(context.bot, update.effective_chat.id):
+        safe_reply_text(update.effective_message, "Profiler chưa chạy. Dùng /profile_start để bắt đầu.")
+
+async def _profile_auto_stop(context: ContextTypes.DEFAULT_TYPE):
+    await _send_profile(context.bot, context.job.data)
+
+async def _send_profile(bot, chat_id) -> bool:
+    res = await profile_stop()
+    if res is None:
+        return False
+    counts, sampler, n_workers = res
+    secs = sampler.stopped - sampler.started
+    caption = [f"🔬 Profile {secs:.0f}s · {sampler.samples} lần lấy mẫu · {n_workers} worker chấm điểm",
+               "Nhiều mẫu nhất:"]
+    caption += [f"- {name}: {n}" for name, n in top_self(counts, 8)]
+    name = datetime.now(TZ).strftime("profile-%Y%m%d-%H%M%S.collapsed.txt")
+    # không chờ gửi xong (handler /profile_stop không giữ slot trong lúc chờ giới hạn tốc độ)
+    data = render_collapsed(counts).encode("utf-8")
+    OUTBOX.submit(chat_id, lambda: bot.send_document(chat_id=chat_id, document=data, filename=name,
+                                                     caption="\n".join(caption)[:1024]), PRIO_NOTICE)
+    return True
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.effective_message.text or "").strip()
@@ -979,141 +3081,169 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return  # không làm phiền
 
     if id_kho not in kho_map:
-        await update.effective_message.reply_text(
+        safe_reply_text(update.effective_message,
             f"❌ ID {id_kho} *không có* trong danh sách. Kiểm tra lại!"
         )
         return
 
-    cur = get_count(load_count_db(), id_kho, d)
-    await update.effective_message.reply_text(
+    cur = db_get_count(id_kho, d)
+    safe_reply_text(update.effective_message,
         f"✅ Đã nhận ID {id_kho} ({kho_map[id_kho]}). Hôm nay hiện có *{cur} / {REQUIRED_PHOTOS}* ảnh. "
         "Gửi ảnh ngay sau đó (không cần caption)."
     )
 
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # === FAST PATH: pick medium photo size & download into memory ===
-    try:
-        sizes = message.photo or []
-        chosen = sizes[-2] if len(sizes) >= 2 else (sizes[-1] if sizes else None)
-        if chosen:
-            tg_file = await chosen.get_file()
-            from io import BytesIO
-            buf = BytesIO()
-            await tg_file.download_to_memory(out=buf)
-            buf.seek(0)
-            import numpy as np, cv2
-            _arr = np.frombuffer(buf.read(), dtype=np.uint8)
-            _img_bgr_fast = cv2.imdecode(_arr, cv2.IMREAD_COLOR)
-            if _img_bgr_fast is not None:
-                img_bgr = _img_bgr_fast
-    except Exception:
-        pass  # fallback to existing path below if any
     msg = update.effective_message
 
-    # ---- ALBUM / MEDIA GROUP ----
+    # ---- ALBUM / MEDIA GROUP: gom cả lô rồi xử lý 1 lần (xem ALBUM COLLECTOR) ----
+    mgid = msg.media_group_id
+    if mgid and ALBUM_WINDOW > 0:
+        album_collect(context, msg)
+        return
+
     caption = (msg.caption.strip() if (msg and getattr(msg, 'caption', None)) else '')
     caption_from_group = caption
-    mgid = msg.media_group_id
     if mgid:
-        albums = context.chat_data.setdefault("albums", {})
-        rec = albums.setdefault(mgid, {"caption": None, "ts": datetime.now(TZ).timestamp()})
-        if caption and not rec["caption"]:
-            rec["caption"] = caption
-        if not caption and rec["caption"]:
-            caption_from_group = rec["caption"]
+        group_caption = ALBUM_CAPTIONS.get((msg.chat_id, mgid))
+        if caption and not group_caption:
+            ALBUM_CAPTIONS[(msg.chat_id, mgid)] = caption
+        if not caption and group_caption:
+            caption_from_group = group_caption
 
     # ---- FALLBACK: dùng text đã lưu trong 2 phút ----
     if not caption_from_group:
         caption_from_group = get_last_text(msg.chat_id) or ""
 
-    # parse
+    await _handle_photos(context, [msg], caption_from_group)
+
+async def _handle_photos(context: ContextTypes.DEFAULT_TYPE, msgs: list, caption_from_group: str):
+    """Parse ID/ngày từ caption chung rồi xử lý các ảnh (1 ảnh lẻ hoặc cả album) dưới khoá kho/ngày."""
     id_kho, d = parse_text_for_id_and_date(caption_from_group)
     kho_map = context.bot_data["kho_map"]
 
     if not id_kho:
-        await msg.reply_text(
-            "⚠️ *Thiếu ID kho.* Thêm ID vào caption hoặc gửi 1 text có ID trước rồi gửi ảnh (trong 2 phút)."
-        )
+        inc("bot5s_photos_total", len(msgs), result="no_id")
+        for msg in msgs:
+            safe_reply_text(msg,
+                "⚠️ *Thiếu ID kho.* Thêm ID vào caption hoặc gửi 1 text có ID trước rồi gửi ảnh (trong 2 phút)."
+            )
         return
 
     if id_kho not in kho_map:
-        await msg.reply_text(
-            f"❌ ID {id_kho} *không có* trong danh sách Excel. Kiểm tra lại!"
-        )
+        inc("bot5s_photos_total", len(msgs), result="unknown_id")
+        for msg in msgs:
+            safe_reply_text(msg,
+                f"❌ ID {id_kho} *không có* trong danh sách Excel. Kiểm tra lại!"
+            )
         return
 
-    # tải bytes ảnh & hash
-    photo = msg.photo[-1]
-    tg_file = await context.bot.get_file(photo.file_id)
-    b = await tg_file.download_as_bytearray()
-    b = bytes(b)
-    h = hashlib.md5(b).hexdigest()
+    # Các ảnh cùng (chat, kho, ngày) xử lý tuần tự theo thứ tự đến; khác kho thì chạy song song
+    t_wait = time.perf_counter()
+    async with key_lock((msgs[0].chat_id, id_kho, d.isoformat())):
+        observe("bot5s_stage_seconds", time.perf_counter() - t_wait, stage="lock_wait")
+        with span("photo_batch"):
+            await _process_photos(context, msgs, id_kho, d, caption_from_group)
 
-    # ===== CẢNH BÁO TRÙNG TRONG CÙNG LÔ (album) =====
-    mg_hashes = context.chat_data.setdefault("mg_hashes", {})
-    if mgid:
-        seen = mg_hashes.setdefault(mgid, set())
-        if h in seen:
-            await msg.reply_text(
-                "⚠️ Có ít nhất 2 ảnh *giống nhau* trong cùng lô gửi. Vui lòng chọn ảnh khác."
+async def _process_photos(context: ContextTypes.DEFAULT_TYPE, msgs: list, id_kho: str, d: date, caption_from_group: str):
+    """
+    Tải/hash, kiểm tra trùng, ghi nhận, chấm điểm và báo tiến độ cho các ảnh cùng kho/ngày
+    (đang giữ key_lock). Ảnh bị từ chối vẫn nhận đúng tin trả lời riêng như khi gửi lẻ.
+    """
+    kho_map = context.bot_data["kho_map"]
+    chat_id = msgs[0].chat_id
+
+    # định danh ảnh (hash) + tải đúng 1 bản ảnh cần dùng, các ảnh cần tải thì tải song song
+    fuids = [m.photo[-1].file_unique_id for m in msgs]
+    hashes, blobs, need = [None] * len(msgs), [None] * len(msgs), []
+    for i, fuid in enumerate(fuids):
+        known = fileid_index_get(fuid)  # ảnh đã từng ghi nhận (forward/gửi lại) → khỏi tải lại
+        if PHOTO_ID_MODE == "file_unique_id":
+            # không cần tải ảnh để biết trùng: Telegram giữ nguyên file_unique_id khi forward/gửi lại
+            hashes[i] = hashlib.md5(fuid.encode("utf-8")).hexdigest()
+        elif known:
+            hashes[i] = known[0]
+        else:
+            need.append(i)
+    if need:
+        # 1 ảnh tải lỗi (get_file/mạng) không làm hỏng cả album: ảnh đó được báo gửi lại, các ảnh khác xử lý bình thường
+        got = await asyncio.gather(*(download_photo(context.bot, pick_photo_size(msgs[i].photo, PHOTO_MAX_SIDE))
+                                     for i in need), return_exceptions=True)
+        for i, b in zip(need, got):
+            if isinstance(b, BaseException):
+                logging.warning("Không tải được ảnh %s: %r", fuids[i], b)
+                continue
+            with span("md5"):
+                blobs[i], hashes[i] = b, hashlib.md5(b).hexdigest()
+
+    # ===== KIỂM TRA TRÙNG (lần lượt theo thứ tự ảnh, như gửi lẻ từng ảnh) =====
+    batch_hashes = set()  # ảnh hợp lệ đứng trước trong cùng lô (chưa có trong HASH INDEX)
+    accepted = []
+    t_dup = time.perf_counter()
+    for i, msg in enumerate(msgs):
+        h, mgid = hashes[i], msg.media_group_id
+        if h is None:
+            inc("bot5s_photos_total", result="download_error")
+            safe_reply_text(msg, "⚠️ Bot không tải được ảnh này từ Telegram. Vui lòng gửi lại ảnh.")
+            continue
+
+        # ===== CẢNH BÁO TRÙNG TRONG CÙNG LÔ (album) =====
+        if mgid:
+            seen = ALBUM_HASHES.setdefault((chat_id, mgid), set())
+            if h in seen:
+                inc("bot5s_photos_total", result="album_dup")
+                safe_reply_text(msg,
+                    "⚠️ Có ít nhất 2 ảnh *giống nhau* trong cùng lô gửi. Vui lòng chọn ảnh khác."
+                )
+                continue
+            seen.add(h)
+
+        # ===== TRÙNG TRONG NGÀY / LỊCH SỬ (tra HASH INDEX) =====
+        # Trùng cùng ngày/kho
+        if h in batch_hashes or hash_index_same_day(h, id_kho, d.isoformat()):
+            inc("bot5s_photos_total", result="same_day")
+            safe_reply_text(msg,
+                f"⚠️ *{kho_map[id_kho]}* hôm nay đã có 1 ảnh *giống hệt* ảnh này. Vui lòng thay ảnh khác."
             )
-            return
-        seen.add(h)
-
-    hash_db = load_hash_db()
-
-    # ===== TRÙNG TRONG NGÀY / LỊCH SỬ =====
-    # Trùng cùng ngày/kho
-    same_day_dups = [
-        item for item in hash_db["items"]
-        if item.get("hash") == h and item.get("id_kho") == id_kho and item.get("date") == d.isoformat()
-    ]
-    if same_day_dups:
-        await msg.reply_text(
-            f"⚠️ *{kho_map[id_kho]}* hôm nay đã có 1 ảnh *giống hệt* ảnh này. Vui lòng thay ảnh khác."
-        )
-        return
+            continue
 
-    # Trùng lịch sử -> log quá khứ (lấy ngày sớm nhất)
-    dups = [item for item in hash_db["items"] if item.get("hash") == h]
-    if dups:
-        prev_dates = sorted(set([it.get("date") for it in dups if it.get("date") != d.isoformat()]))
-        if prev_dates:
-            log_past_use(id_kho=id_kho, prev_date=prev_dates[0], h=h, today=d)
+        # Trùng lịch sử -> log quá khứ (lấy ngày sớm nhất)
+        prev_date = hash_index_earliest_prev(h, d.isoformat())
+        if prev_date:
+            inc("bot5s_photos_total", result="past")
+            log_past_use(id_kho=id_kho, prev_date=prev_date, h=h, today=d)
             try:
-                dup_date_txt = datetime.fromisoformat(prev_dates[0]).strftime("%d/%m/%Y")
+                dup_date_txt = datetime.fromisoformat(prev_date).strftime("%d/%m/%Y")
             except Exception:
-                dup_date_txt = prev_dates[0]
+                dup_date_txt = prev_date
 
             warn = f"⚠️ Ảnh *trùng* với ảnh đã gửi trước đây ngày {dup_date_txt}. Vui lòng chụp ảnh mới khác để tránh trùng lặp."
-            await msg.reply_text(
+            safe_reply_text(msg,
                 warn
             )
-            return
-
-    # ===== GHI NHẬN ẢNH HỢP LỆ =====
-    # ghi nhận nộp
-    submit_db = load_submit_db()
-    mark_submitted(submit_db, id_kho, d)
-    save_submit_db(submit_db)
+            continue
 
-    # lưu hash
-    info = {
-        "ts": datetime.now(TZ).isoformat(timespec="seconds"),
-        "chat_id": msg.chat_id,
-        "user_id": msg.from_user.id,
-        "id_kho": id_kho,
-        "date": d.isoformat(),
-    }
-    hash_db["items"].append({"hash": h, **info})
-    save_hash_db(hash_db)
+        batch_hashes.add(h)
+        accepted.append(i)
+    observe("bot5s_stage_seconds", time.perf_counter() - t_dup, stage="dup_check")
+    if not accepted:
+        await storage_sync()  # log ảnh quá khứ
+        return
 
-    # đếm số ảnh và **GỘP** phản hồi theo kho/ngày
-    count_db = load_count_db()
-    cur = inc_count(count_db, id_kho, d, step=1)
-    save_count_db(count_db)
+    # ===== GHI NHẬN ẢNH HỢP LỆ =====
+    # ghi nhận nộp + lưu hash + đếm số ảnh (cả lô 1 lần ghi, xem db_record_photos)
+    inc("bot5s_photos_total", len(accepted), result="accepted")
+    ts = datetime.now(TZ).isoformat(timespec="seconds")
+    with span("db_record"):
+        counts = db_record_photos([(hashes[i], {
+            "ts": ts,
+            "chat_id": msgs[i].chat_id,
+            "user_id": msgs[i].from_user.id,
+            "id_kho": id_kho,
+            "date": d.isoformat(),
+            "file_unique_id": fuids[i],
+        }) for i in accepted])
+    await storage_sync()  # journal lưu bền (fsync ở thread) trước khi báo đã ghi nhận
 
-    
     # ===== CHẤM ĐIỂM 5S (rule-based, không ML) =====
     if SCORING_ENABLED and SCORING_MODE == "rule":
         # Lấy KV từ caption/text nếu có
@@ -1121,29 +3251,46 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         m_kv = AREA_RX.search(caption_from_group or "")
         if m_kv:
             kv_text = m_kv.group(1)
-        reply_text = apply_scoring_rule(b, kv_text or "", is_duplicate=False)
-        dupkey = _dup_key(msg.chat_id, str(id_kho))
-        ngay_text = d.strftime('%d/%m/%Y')
-        item = apply_scoring_struct(b, kv_text or "", False, dupkey, ngay_text)
-        key = _scoring_key(msg.chat_id, str(id_kho), ngay_text)
-        SCORING_BUFFER[key].append(item)
-
-    await ack_photo_progress(context, msg.chat_id, id_kho, kho_map[id_kho], d, cur)
+        missing = [i for i in accepted if blobs[i] is None]
+        if missing:
+            # ảnh đã ghi nhận: tải lỗi thì chỉ bỏ qua chấm điểm ảnh đó, vẫn báo tiến độ/cảnh báo bình thường
+            got = await asyncio.gather(*(download_photo(context.bot, pick_photo_size(msgs[i].photo, _scoring_photo_side()))
+                                         for i in missing), return_exceptions=True)
+            for i, b in zip(missing, got):
+                if isinstance(b, BaseException):
+                    logging.warning("Không tải được ảnh %s để chấm điểm: %r", fuids[i], b)
+                    inc("bot5s_scoring_skipped_total", reason="download_error")
+                else:
+                    blobs[i] = b
+        to_score = [i for i in accepted if blobs[i] is not None]
+        # OpenCV chạy ở worker (score_photo_async); phần so trùng/diễn giải chạy tại đây
+        feats = await asyncio.gather(*(score_photo_async(blobs[i], kv_text or "") for i in to_score))
+        scored = [(hashes[i], f) for i, f in zip(to_score, feats) if f is not None]
+        if scored:
+            ngay_text = d.strftime('%d/%m/%Y')
+            with span("scoring_finish"):
+                items = finish_scoring_batch([f for _, f in scored], _dup_key(chat_id, str(id_kho)), ngay_text)
+            SCORING_BUFFER[_scoring_key(chat_id, str(id_kho), ngay_text)].extend(items)
+            try:
+                with span("feature_store"):
+                    feature_store_append([(h, f, it) for (h, f), it in zip(scored, items)], d, str(id_kho))
+            except Exception as e:
+                logging.warning("Không ghi được feature store: %s", e)
+
+    with span("ack_progress"):
+        await ack_photo_progress(context, chat_id, id_kho, kho_map[id_kho], d, counts)
     # Đặt cảnh báo trễ 6s sau mỗi lần ghi nhận (job sẽ tự kiểm tra và chỉ gửi nếu <4 hoặc >4)
-    schedule_delayed_warning(context, msg.chat_id, id_kho, d)
+    schedule_delayed_warning(context, chat_id, id_kho, d)
 
     # Gửi đánh giá 5S thành 1 tin nhắn, trễ 5 giây sau khi báo ghi nhận
     if SCORING_ENABLED and SCORING_MODE == "rule":
         try:
-            schedule_scoring_aggregate(context, chat_id=msg.chat_id, id_kho=str(id_kho), ngay_str=d.strftime('%d/%m/%Y'), delay_seconds=5)
+            schedule_scoring_aggregate(context, chat_id=chat_id, id_kho=str(id_kho), ngay_str=d.strftime('%d/%m/%Y'), delay_seconds=5)
         except Exception:
             pass
-# ========= BÁO CÁO 21:00 =========
-def get_missing_ids_for_day(kho_map, submit_db, d: date):
-    submitted = set(submit_db.get(d.isoformat(), []))
-    all_ids = set(kho_map.keys())
-    return sorted(all_ids - submitted)
 
+# ========= BÁO CÁO 21:00 =========
+@timed("daily_report")
 async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
     # danh sách chat nhận báo cáo
     chat_ids = DEFAULT_REPORT_CHAT_IDS[:]
@@ -1154,36 +3301,21 @@ async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
         return
 
     kho_map = context.bot_data["kho_map"]
-    submit_db = load_submit_db()
-    count_db = load_count_db()
-    past_db = load_past_db()
     today = datetime.now(TZ).date()
 
+    agg = day_agg(today)
+
     # 1) Chưa báo cáo
-    missing_ids = get_missing_ids_for_day(kho_map, submit_db, today)
-
-    # 2) Ảnh cũ/quá khứ: gom theo kho, lấy 1 ngày đại diện (sớm nhất) để báo gọn
-    past_uses = past_db.get(today.isoformat(), [])
-    past_by_kho = {}
-    for it in past_uses:
-        kid = it.get("id_kho"); prev = it.get("prev_date")
-        if not kid or not prev:
-            continue
-        s = past_by_kho.setdefault(kid, set())
-        s.add(prev)
+    missing_ids = sorted(day_agg_missing(agg, kho_map))
+
+    # 2) Ảnh cũ/quá khứ: mỗi kho 1 ngày đại diện (sớm nhất) để báo gọn
     past_lines = []
-    for kid, dates in sorted(past_by_kho.items()):
-        rep = min(dates)
+    for kid, rep in sorted(agg["past"].items()):
         rep_str = datetime.fromisoformat(rep).strftime("%d/%m/%Y")
         past_lines.append(f"- {kid}: trùng ảnh ngày {rep_str}")
 
     # 3) CHỈ liệt kê CHƯA ĐỦ số ảnh
-    not_enough_list = []
-    day_counts = count_db.get(today.isoformat(), {})
-    for kid in kho_map.keys():
-        c = int(day_counts.get(kid, 0))
-        if 0 < c < REQUIRED_PHOTOS:
-            not_enough_list.append((kid, c))
+    not_enough_list = [(kid, agg["counts"][kid]) for kid in agg["under"] if kid in kho_map]
 
     parts = []
     # 1) Chưa báo cáo 5S — HIỂN THỊ ID - TÊN KHO
@@ -1231,42 +3363,439 @@ async def ignore_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # Không khớp -> để các handler khác xử lý
 
+async def _post_init(app: Application):
+    start_watchdog()
+    if SCORING_ENABLED and SCORING_WORKERS > 0:
+        # ProcessPoolExecutor chỉ tạo process khi có việc: gửi mỗi worker 1 việc nhẹ để cả pool khởi động
+        # và import OpenCV ngay, ảnh đầu tiên không phải chờ (không await, không chặn khởi động bot)
+        pool = _scoring_pool()
+        for _ in range(SCORING_WORKERS):
+            pool.submit(_import_cv)
+
+async def _post_stop(app: Application):
+    await OUTBOX.drain()  # gửi nốt tin đang chờ trước khi đóng kết nối Telegram
+    stop_watchdog()
+
+async def _post_shutdown(app: Application):
+    shutdown_scoring_pool()
+    _profile_cleanup()  # tắt bot khi chưa /profile_stop
+    stop_update_log()
+    flush_storage()
+
+class MetricsJobQueue(JobQueue):
+    """JobQueue đếm số lần chạy và thời gian chạy của từng job (theo tên hàm callback)."""
+
+    @staticmethod
+    async def job_callback(job_queue, job):
+        name = getattr(job.callback, "__name__", "?")
+        inc("bot5s_jobs_run_total", job=name)
+        watch_current(f"job {name}")
+        with span("job", job=name):
+            await job.run(job_queue.application)
+
+def register_bot_metrics(app: Application):
+    """Số liệu đọc lúc xuất (/metrics): hàng đợi gửi tin, cache, job đang hẹn..."""
+    register_collector("bot5s_outbox_events_total",
+                       lambda: {(("event", k),): v for k, v in OUTBOX.stats.items()}, kind="counter")
+    register_collector("bot5s_outbox_pending", OUTBOX.pending)
+    register_collector("bot5s_cache_keys", lambda: {(("cache", k),): v["size"] for k, v in cache_stats().items()})
+    register_collector("bot5s_cache_evicted_total", lambda: {
+        (("cache", k), ("reason", r)): v[f"evicted_{r}"] for k, v in cache_stats().items() for r in ("ttl", "lru")
+    }, kind="counter")
+    register_collector("bot5s_scoring_inflight", lambda: _SCORING_INFLIGHT)
+    register_collector("bot5s_key_locks", lambda: len(_KEY_LOCKS))
+    register_collector("bot5s_kho_total", lambda: len(app.bot_data.get("kho_map") or {}))
+
+    def jobs_scheduled():
+        counts = {}
+        for j in app.job_queue.jobs():
+            k = (("job", j.callback.__name__),)
+            counts[k] = counts.get(k, 0) + 1
+        return counts
+    register_collector("bot5s_jobs_scheduled", jobs_scheduled)
+
 def build_app() -> Application:
     token = os.getenv("BOT_TOKEN", "").strip()
     if not token:
         raise RuntimeError("Thiếu biến môi trường BOT_TOKEN")
 
-    app = (ApplicationBuilder()
+    builder = ApplicationBuilder()
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    if BOT_API_FILE_URL:
+        builder = builder.base_file_url(BOT_API_FILE_URL)
+    app = (builder
     .token(token)
+    .job_queue(MetricsJobQueue())
     .connect_timeout(30)
     .read_timeout(45)
     .write_timeout(45)
     .pool_timeout(10)
     .get_updates_read_timeout(60)
+    .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+    .post_init(_post_init)
+    .post_stop(_post_stop)
+    .post_shutdown(_post_shutdown)
     .build())
     app.bot_data["kho_map"] = load_kho_map()
-
+    if STORAGE_BACKEND == "sqlite":
+        _sql_conn()  # mở DB + chuyển dữ liệu JSON cũ (1 lần) ngay khi khởi động
+    _hash_index()    # nạp HASH INDEX 1 lần (các lần restart vòng lặp dùng lại)
+    if SCORING_ENABLED:
+        _phash_index()  # nạp pHash INDEX (lịch sử ảnh gần giống) từ file
+
+    register_bot_metrics(app)
+    start_metrics_server()
+
+    if LOOP_LAG_THRESHOLD > 0:
+        app.add_handler(TypeHandler(Update, watch_update), group=-2)
+    if UPDATE_LOG_PATH:
+        app.add_handler(TypeHandler(Update, record_update), group=-1)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
     app.add_handler(CommandHandler("chatid", chatid))
     app.add_handler(CommandHandler("report_now", report_now))
+    admin = filters.User(user_id=ADMIN_USER_IDS)
+    app.add_handler(CommandHandler("stats", cmd_stats, filters=admin))
+    app.add_handler(CommandHandler("profile_start", cmd_profile_start, filters=admin))
+    app.add_handler(CommandHandler("profile_stop", cmd_profile_stop, filters=admin))
     app.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, photo_handler))
     # Im lặng với tin nhắn chỉ toàn số
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r"^\s*[\d\s.,-]+\s*$"), ignore_numbers))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
+    if KHO_RELOAD_INTERVAL > 0:
+        app.job_queue.run_repeating(kho_map_watch_job, interval=KHO_RELOAD_INTERVAL, first=KHO_RELOAD_INTERVAL,
+                                    name="kho_map_watch")
+    app.job_queue.run_repeating(sweep_caches_job, interval=CACHE_SWEEP_INTERVAL, first=CACHE_SWEEP_INTERVAL,
+                                name="sweep_caches")
     app.job_queue.run_daily(
         send_daily_report,
         time=dtime(hour=REPORT_HOUR, minute=0, tzinfo=TZ),
         name="daily_report_21h"
     )
+    if STORAGE_BACKEND == "json" and RETENTION_DAYS > 0:
+        app.job_queue.run_daily(compact_storage_job, time=dtime(hour=COMPACT_HOUR, minute=0, tzinfo=TZ),
+                                name="compact_storage")
+        app.job_queue.run_once(compact_storage_job, when=60, name="compact_storage_boot")
     return app
 
+# ========= WEBHOOK / GHI & PHÁT LẠI UPDATE =========
+# RUN_MODE        : polling (mặc định) | webhook
+# WEBHOOK_URL     : URL công khai (https) trỏ tới bot, vd. https://ten-app.up.railway.app
+# WEBHOOK_PATH    : đường dẫn nhận update (mặc định "telegram")
+# WEBHOOK_LISTEN / WEBHOOK_PORT : địa chỉ/cổng HTTP server nội bộ (mặc định 0.0.0.0 / $PORT hoặc 8443)
+# WEBHOOK_SECRET  : secret token; request thiếu header X-Telegram-Bot-Api-Secret-Token đúng bị từ chối
+# UPDATE_LOG_PATH : nếu đặt, ghi JSON mọi update nhận được (1 dòng/update) để phát lại bằng `replay-updates`
+import argparse
+
+RUN_MODE = os.getenv("RUN_MODE", "polling").strip().lower() or "polling"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+UPDATE_LOG_PATH = os.getenv("UPDATE_LOG_PATH", "").strip()
+
+_UPDATE_LOG_Q = queue.Queue()
+_UPDATE_LOG_THREAD = None
+
+def _update_log_writer():
+    """Thread nền: ghi các dòng update đang chờ theo lô (None = ghi nốt rồi dừng)."""
+    with open(UPDATE_LOG_PATH, "a", encoding="utf-8") as f:
+        while True:
+            lines = [_UPDATE_LOG_Q.get()]
+            while True:
+                try:
+                    lines.append(_UPDATE_LOG_Q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            try:
+                f.write("".join(x for x in lines if x is not None))
+                f.flush()
+            except Exception:
+                logging.exception("Ghi UPDATE_LOG_PATH lỗi")
+            if stop:
+                return
+
+def stop_update_log():
+    """Ghi nốt update đang chờ (gọi khi tắt bot)."""
+    global _UPDATE_LOG_THREAD
+    t, _UPDATE_LOG_THREAD = _UPDATE_LOG_THREAD, None
+    if t is not None:
+        _UPDATE_LOG_Q.put(None)
+        t.join(timeout=5)
+
+atexit.register(stop_update_log)
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # chỉ xếp hàng trên event loop; ghi file ở thread nền
+    global _UPDATE_LOG_THREAD
+    if _UPDATE_LOG_THREAD is None:
+        _UPDATE_LOG_THREAD = threading.Thread(target=_update_log_writer, name="update-log", daemon=True)
+        _UPDATE_LOG_THREAD.start()
+    _UPDATE_LOG_Q.put(json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
+
+def run_app(app: Application):
+    """Chạy bot theo RUN_MODE (chặn tới khi dừng)."""
+    if RUN_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("RUN_MODE=webhook cần biến môi trường WEBHOOK_URL")
+        # webhook: Telegram giữ update chờ trong lúc bot restart → không bỏ update nào
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=False,
+            close_loop=False,
+        )
+    else:
+        # Giữ tham số như cũ để không thay đổi hành vi
+        app.run_polling(close_loop=False, drop_pending_updates=True)
+
+def _read_updates(path: str) -> list:
+    """Đọc file update: JSON lines (như UPDATE_LOG_PATH) hoặc 1 mảng JSON."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(ln) for ln in text.splitlines() if ln.strip()]
+
+def cli_replay_updates(argv) -> int:
+    """python bot.py replay-updates FILE — POST lại các update đã ghi vào webhook đang chạy (không cần Telegram)."""
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    ap = argparse.ArgumentParser(prog="bot.py replay-updates", description="Phát lại update Telegram vào webhook nội bộ")
+    ap.add_argument("file", help="file JSON lines hoặc mảng JSON các Update")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    ap.add_argument("--secret", default=WEBHOOK_SECRET)
+    ap.add_argument("--concurrency", type=int, default=1, help="số request gửi song song (mặc định 1 = đúng thứ tự)")
+    ap.add_argument("--delay", type=float, default=0.0, help="giây nghỉ giữa 2 update (khi concurrency = 1)")
+    args = ap.parse_args(argv)
+
+    updates = _read_updates(args.file)
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    def post(upd):
+        req = urllib.request.Request(args.url, data=json.dumps(upd).encode("utf-8"), headers=headers, method="POST")
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=30) as r:
+                status = r.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError:
+            status = 0
+        return status, time.perf_counter() - t0
+
+    t_start = time.perf_counter()
+    if args.concurrency <= 1:
+        results = []
+        for upd in updates:
+            results.append(post(upd))
+            if args.delay:
+                time.sleep(args.delay)
+    else:
+        with ThreadPoolExecutor(args.concurrency) as ex:
+            results = list(ex.map(post, updates))
+    total = time.perf_counter() - t_start
+
+    ok = sum(1 for st, _ in results if st == 200)
+    lat = sorted(dt for _, dt in results)
+    def pct(p):
+        return lat[min(len(lat) - 1, int(p * len(lat)))] * 1000 if lat else 0.0
+    print(f"{ok}/{len(results)} update OK trong {total:.2f}s "
+          f"({len(results) / total if total else 0:.1f} update/s) · "
+          f"p50 {pct(0.50):.1f} ms · p95 {pct(0.95):.1f} ms · p99 {pct(0.99):.1f} ms")
+    bad = {st for st, _ in results if st != 200}
+    if bad:
+        print("HTTP status lỗi:", ", ".join(str(x) for x in sorted(bad)))
+    return 0 if ok == len(results) else 1
+
+# ========= CHẤM ĐIỂM ẢNH OFFLINE (CLI score-dir) =========
+# python bot.py score-dir THƯ_MỤC --kv HangHoa --workers 4 [--format csv|jsonl] [-o kq.csv]
+# Chấm lại cả thư mục ảnh (đệ quy) bằng đúng công thức của bot, không cần Telegram; không đụng pHash INDEX/DB.
+# Mỗi ảnh 1 dòng: total, grade, từng chỉ số theo KV (part_*), chất lượng (sharp/bright/size, kích thước), pHash.
+SCORE_DIR_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+def _iter_images(root: str):
+    if os.path.isfile(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(SCORE_DIR_EXTS):
+                yield os.path.join(dirpath, name)
+
+def _score_file(path: str, kv_text: str) -> dict:
+    """Chạy ở worker: đọc ảnh từ đĩa + tính features (không trả bytes ảnh về process chính)."""
+    try:
+        with open(path, "rb") as f:
+            ctx = ImageCtx(photo_bytes=f.read())
+        if ctx.img is None:
+            return {"error": "không đọc được ảnh"}
+        return extract_scoring_features(ctx, kv_text)
+    except Exception as e:
+        return {"error": repr(e)}
+
+def score_row(path: str, feats: dict) -> dict:
+    if "error" in feats:
+        return {"path": path, "error": feats["error"]}
+    total, grade = score_total(feats)
+    sharp_s, bright_s, size_s, (w, h) = feats["quality"]
+    row = {"path": path, "kv": feats["kv_key"], "total": total, "grade": grade}
+    row.update({f"part_{k}": round(float(v), 6) for k, v in feats["parts"].items()})
+    row.update({"sharp": round(float(sharp_s), 6), "bright": round(float(bright_s), 6), "size": round(float(size_s), 6),
+                "width": int(w), "height": int(h),
+                "phash": f"{feats['phash']:016x}" if feats.get("phash") is not None else ""})
+    return row
+
+def cli_score_dir(argv) -> int:
+    """python bot.py score-dir PATH — chấm điểm 5S hàng loạt ảnh trên đĩa (process pool), ghi CSV/JSONL."""
+    import csv
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    ap = argparse.ArgumentParser(prog="bot.py score-dir", description="Chấm điểm 5S cả thư mục ảnh (không cần Telegram)")
+    ap.add_argument("path", help="thư mục ảnh (quét đệ quy) hoặc 1 file ảnh")
+    ap.add_argument("--kv", default="", help="khu vực: HangHoa | WC | KhoBai | VanPhong (như KV trong caption)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="số process chấm điểm (0 = chạy tuần tự)")
+    ap.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    ap.add_argument("-o", "--output", help="file kết quả (mặc định: in ra màn hình)")
+    args = ap.parse_args(argv)
+
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    writer = None
+    if args.format == "csv":
+        # cột cố định theo KV; ảnh lỗi vẫn có 1 dòng (cột điểm để trống, lý do ở cột error) → số dòng = số ảnh
+        fields = (["path", "kv", "total", "grade"] + [f"part_{m}" for m in _DEFAULT_WEIGHTS[_kv_key_from_text(args.kv)]]
+                  + ["sharp", "bright", "size", "width", "height", "phash", "error"])
+        writer = csv.DictWriter(out, fieldnames=fields, restval="", extrasaction="ignore")
+        writer.writeheader()
+    grades, errors, n = {}, 0, 0
+    t0 = time.perf_counter()
+
+    def emit(path, feats):
+        nonlocal errors, n
+        row = score_row(os.path.relpath(path, args.path) if os.path.isdir(args.path) else path, feats)
+        n += 1
+        if "error" in row:
+            errors += 1
+            print(f"Lỗi {path}: {row['error']}", file=sys.stderr)
+        else:
+            grades[row["grade"]] = grades.get(row["grade"], 0) + 1
+        if writer is None:
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            writer.writerow(row)
+        if n % 200 == 0:
+            print(f"... {n} ảnh · {n / (time.perf_counter() - t0):.1f} ảnh/giây", file=sys.stderr)
+
+    try:
+        if args.workers <= 0:
+            for path in _iter_images(args.path):
+                emit(path, _score_file(path, args.kv))
+        else:
+            with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_import_cv) as pool:
+                # giữ tối đa workers×4 ảnh đang chấm: đọc dần thư mục, kết quả ghi theo đúng thứ tự file
+                window = deque()
+                for path in _iter_images(args.path):
+                    window.append((path, pool.submit(_score_file, path, args.kv)))
+                    if len(window) >= args.workers * 4:
+                        p, fut = window.popleft()
+                        emit(p, fut.result())
+                while window:
+                    p, fut = window.popleft()
+                    emit(p, fut.result())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - t0
+    print(f"Xong {n} ảnh trong {elapsed:.1f}s ({n / elapsed if elapsed else 0:.1f} ảnh/giây) · "
+          + " · ".join(f"{g}={c}" for g, c in sorted(grades.items())) + (f" · lỗi={errors}" if errors else ""),
+          file=sys.stderr)
+    return 1 if errors else 0
+
+def cli_rescore(argv) -> int:
+    """python bot.py rescore — tính lại điểm 5S cả lịch sử từ FEATURE_STORE_PATH theo trọng số/ngưỡng mới."""
+    import csv
+
+    ap = argparse.ArgumentParser(prog="bot.py rescore",
+                                 description="Tính lại điểm 5S mọi ảnh đã chấm (feature store) theo trọng số/ngưỡng mới, không cần ảnh")
+    ap.add_argument("--weights", help='JSON như AREA_RULE_WEIGHTS, vd. \'{"WC": {"stain": 50, "trash": 30, "dry": 20}}\' '
+                                      "(mặc định: cấu hình hiện tại)")
+    ap.add_argument("--thresholds", help="JSON như AREA_RULE_THRESHOLDS (mặc định: cấu hình hiện tại)")
+    ap.add_argument("--store", default=FEATURE_STORE_PATH, help="file feature store (mặc định FEATURE_STORE_PATH)")
+    ap.add_argument("--from", dest="date_from", type=date.fromisoformat, help="từ ngày YYYY-MM-DD")
+    ap.add_argument("--to", dest="date_to", type=date.fromisoformat, help="đến ngày YYYY-MM-DD")
+    ap.add_argument("--kho", help="chỉ 1 id kho")
+    ap.add_argument("-o", "--output", help="ghi CSV từng ảnh: điểm đã gửi → điểm mới")
+    args = ap.parse_args(argv)
+
+    weights = json.loads(args.weights) if args.weights else None
+    thresholds = json.loads(args.thresholds) if args.thresholds else None
+    t0 = time.perf_counter()
+    rec = feature_store_load(args.store)
+    keep = np.ones(len(rec), dtype=bool)
+    if args.date_from:
+        keep &= rec["day"] >= args.date_from.toordinal()
+    if args.date_to:
+        keep &= rec["day"] <= args.date_to.toordinal()
+    if args.kho:
+        keep &= rec["kho"] == np.uint64(int(args.kho))
+    rec = rec[keep]
+    if not len(rec):
+        print(f"Không có ảnh nào trong {args.store}", file=sys.stderr)
+        return 1
+    res = rescore_features(rec, weights, thresholds)
+    elapsed = time.perf_counter() - t0
+
+    old_total = rec["total"].astype(np.int64)
+    old_grade = np.where(old_total >= 80, "A", np.where(old_total >= 65, "B", "C"))
+    delta = res["total"] - old_total
+    print(f"{len(rec)} ảnh · tính lại trong {elapsed * 1000:.0f} ms")
+    print(f"Điểm thay đổi: {int((delta != 0).sum())} ảnh · đổi hạng: {int((res['grade'] != old_grade).sum())} ảnh · "
+          f"Δ trung bình {delta.mean():+.2f} (min {delta.min():+d}, max {delta.max():+d})")
+    for g in ("A", "B", "C"):
+        print(f"  Hạng {g}: {int((old_grade == g).sum()):6d} → {int((res['grade'] == g).sum()):6d}")
+    print("Tỉ lệ hạng mục dưới ngưỡng (→ vấn đề/khuyến nghị):")
+    for k, kv in enumerate(_FS_KVS):
+        m = rec["kv"] == k
+        if m.any():
+            rates = " · ".join(f"{name} {res['below'][m, j].mean() * 100:.0f}%" for j, name in enumerate(_FS_METRICS[kv]))
+            print(f"  {kv} ({int(m.sum())} ảnh): {rates}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["md5", "ngay", "id_kho", "kv", "total_cu", "hang_cu", "total_moi", "hang_moi", "duoi_nguong"])
+            for i in range(len(rec)):
+                kv = _FS_KVS[rec["kv"][i]]
+                below = [name for j, name in enumerate(_FS_METRICS[kv]) if res["below"][i, j]]
+                w.writerow([rec["md5"][i].tobytes().hex(), date.fromordinal(int(rec["day"][i])).isoformat(),
+                            int(rec["kho"][i]), kv, int(old_total[i]), old_grade[i],
+                            int(res["total"][i]), res["grade"][i], " ".join(below)])
+    return 0
+
+CLI_COMMANDS = {
+    "replay-updates": cli_replay_updates,
+    "score-dir": cli_score_dir,
+    "rescore": cli_rescore,
+}
+
 def main():
     app = build_app()
     print("Bot is running...")
-    app.run_polling(close_loop=False, drop_pending_updates=True)
+    run_app(app)
 
 import logging
 import time
@@ -1279,13 +3808,14 @@ logging.basicConfig(
 )
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(CLI_COMMANDS[sys.argv[1]](sys.argv[2:]))
     while True:
         try:
             # build_app() là hàm bạn đã có sẵn ở trên
             app = build_app()
-            logging.info("Bot is running...")
-            # Giữ tham số như cũ để không thay đổi hành vi
-            app.run_polling(close_loop=False, drop_pending_updates=True)
+            logging.info("Bot is running (%s)...", RUN_MODE)
+            run_app(app)
 
         except (NetworkError, TimedOut) as e:
             logging.error(f"Lỗi mạng: {e} → thử lại sau 5s")